@@ -0,0 +1,167 @@
+import numpy as np
+from abc import ABC, abstractmethod
+from typing import Dict, List, Union
+from config import CHUNK, RATE, CHANNELS
+
+try:
+    import opuslib
+except ImportError:  # Opus是可选依赖
+    opuslib = None
+
+# 编解码器ID，随音频数据一起发送，使不同版本的客户端可以互通
+PCM16 = 0
+MULAW = 1
+OPUS = 2
+
+# Opus只支持2.5/5/10/20/40/60ms的帧长
+OPUS_FRAME_DURATIONS_MS = (2.5, 5, 10, 20, 40, 60)
+
+AudioData = Union[bytes, np.ndarray]
+
+
+def _as_samples(pcm: AudioData) -> np.ndarray:
+    """把16位PCM字节或数组统一成int16数组（不复制）"""
+    if isinstance(pcm, np.ndarray):
+        return pcm
+    return np.frombuffer(pcm, dtype=np.int16)
+
+
+class AudioCodec(ABC):
+    """音频编解码器基类"""
+    codec_id = PCM16
+    name = 'pcm16'
+
+    @abstractmethod
+    def encode(self, pcm: AudioData) -> bytes:
+        """编码一帧16位PCM"""
+
+    @abstractmethod
+    def decode(self, payload: bytes) -> np.ndarray:
+        """解码一帧数据，返回int16数组"""
+
+
+class PCMCodec(AudioCodec):
+    """原始16位PCM，不压缩，用于兼容旧客户端"""
+    codec_id = PCM16
+    name = 'pcm16'
+
+    def encode(self, pcm: AudioData) -> bytes:
+        return pcm.tobytes() if isinstance(pcm, np.ndarray) else pcm
+
+    def decode(self, payload: bytes) -> np.ndarray:
+        return np.frombuffer(payload, dtype=np.int16)
+
+
+def _build_mulaw_tables():
+    """生成G.711 μ-law的编码表（65536项）和解码表（256项）"""
+    bias, clip = 0x84, 32635
+    samples = np.arange(-32768, 32768, dtype=np.int32)
+    sign = (samples < 0).astype(np.int32) << 7
+    magnitude = np.minimum(np.abs(samples), clip) + bias
+    exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 7
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    encoded = (~(sign | (exponent << 4) | mantissa)) & 0xFF
+    # 以uint16视图作为索引，使编码只需一次查表
+    encode_table = np.empty(65536, dtype=np.uint8)
+    encode_table[samples.astype(np.int16).view(np.uint16)] = encoded
+
+    codes = (~np.arange(256, dtype=np.int32)) & 0xFF
+    decoded = (((codes & 0x0F) << 3) + bias) << ((codes >> 4) & 0x07)
+    decoded -= bias
+    decode_table = np.where(codes & 0x80, -decoded, decoded).astype(np.int16)
+    return encode_table, decode_table
+
+
+_MULAW_ENCODE, _MULAW_DECODE = _build_mulaw_tables()
+
+
+class MuLawCodec(AudioCodec):
+    """G.711 μ-law，每个采样8位，纯NumPy查表实现，带宽减半"""
+    codec_id = MULAW
+    name = 'mulaw'
+
+    def encode(self, pcm: AudioData) -> bytes:
+        samples = _as_samples(pcm)
+        return _MULAW_ENCODE[samples.view(np.uint16)].tobytes()
+
+    def decode(self, payload: bytes) -> np.ndarray:
+        return _MULAW_DECODE[np.frombuffer(payload, dtype=np.uint8)]
+
+
+class OpusCodec(AudioCodec):
+    """Opus编解码器（需要安装opuslib），有状态，每个音频流需要独立的实例"""
+    codec_id = OPUS
+    name = 'opus'
+
+    def __init__(self, rate=RATE, channels=CHANNELS, frame_size=CHUNK):
+        self.frame_size = frame_size
+        self._encoder = None
+        self._decoder = None
+        self._rate = rate
+        self._channels = channels
+
+    @staticmethod
+    def is_available(rate=RATE, frame_size=CHUNK) -> bool:
+        """opuslib已安装，并且CHUNK是Opus支持的帧长"""
+        if opuslib is None:
+            return False
+        return any(frame_size * 1000 == rate * duration for duration in OPUS_FRAME_DURATIONS_MS)
+
+    def encode(self, pcm: AudioData) -> bytes:
+        if self._encoder is None:
+            self._encoder = opuslib.Encoder(self._rate, self._channels, opuslib.APPLICATION_VOIP)
+        data = pcm.tobytes() if isinstance(pcm, np.ndarray) else pcm
+        return self._encoder.encode(data, self.frame_size)
+
+    def decode(self, payload: bytes) -> np.ndarray:
+        if self._decoder is None:
+            self._decoder = opuslib.Decoder(self._rate, self._channels)
+        return np.frombuffer(self._decoder.decode(bytes(payload), self.frame_size), dtype=np.int16)
+
+
+_CODEC_CLASSES = {
+    PCM16: PCMCodec,
+    MULAW: MuLawCodec,
+    OPUS: OpusCodec,
+}
+
+
+def available_codecs(rate=RATE, frame_size=CHUNK) -> List[int]:
+    """本机在给定音频格式下可用的编解码器ID，按优先级从高到低排列"""
+    codecs = [MULAW, PCM16]
+    if OpusCodec.is_available(rate, frame_size):
+        codecs.insert(0, OPUS)
+    return codecs
+
+
+def create_codec(codec_id: int, rate=RATE, channels=CHANNELS, frame_size=CHUNK) -> AudioCodec:
+    """创建编解码器实例，未知ID按原始PCM处理"""
+    if codec_id == OPUS:
+        return OpusCodec(rate, channels, frame_size)
+    return _CODEC_CLASSES.get(codec_id, PCMCodec)()
+
+
+def negotiate_codec(offered: List[int], rate=RATE, frame_size=CHUNK) -> int:
+    """从对方支持的编解码器中选出本机优先级最高的一个，旧客户端没有声明时使用PCM"""
+    for codec_id in available_codecs(rate, frame_size):
+        if codec_id in offered:
+            return codec_id
+    return PCM16
+
+
+class CodecSet:
+    """按编解码器ID缓存有状态的编解码器实例（每个音频流一组）"""
+    def __init__(self, rate=RATE, channels=CHANNELS, frame_size=CHUNK):
+        self._codecs: Dict[int, AudioCodec] = {}
+        self._format = (rate, channels, frame_size)
+
+    def get(self, codec_id: int) -> AudioCodec:
+        if codec_id not in self._codecs:
+            self._codecs[codec_id] = create_codec(codec_id, *self._format)
+        return self._codecs[codec_id]
+
+    def encode(self, codec_id: int, pcm: AudioData) -> bytes:
+        return self.get(codec_id).encode(pcm)
+
+    def decode(self, codec_id: int, payload: bytes) -> np.ndarray:
+        return self.get(codec_id).decode(payload)
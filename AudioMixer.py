@@ -1,44 +1,504 @@
-import numpy as np
-from typing import Dict
-
-class AudioMixer:
-    def __init__(self):
-        self.audio_buffers: Dict[str, bytes] = {}
-        
-    def add_audio_stream(self, user_id: str, audio_data: bytes):
-        """添加用户的音频流到缓冲区"""
-        self.audio_buffers[user_id] = audio_data
-        
-    def remove_audio_stream(self, user_id: str):
-        """移除用户的音频流"""
-        if user_id in self.audio_buffers:
-            del self.audio_buffers[user_id]
-            
-    def mix_audio(self) -> bytes:
-        """混合所有音频流"""
-        if not self.audio_buffers:
-            return b''
-            
-        # 转换所有音频数据为numpy数组
-        audio_arrays = []
-        for audio_data in self.audio_buffers.values():
-            # 将字节转换为16位整数数组
-            array = np.frombuffer(audio_data, dtype=np.int16)
-            audio_arrays.append(array)
-            
-        # 确保所有数组长度相同
-        min_length = min(len(arr) for arr in audio_arrays)
-        audio_arrays = [arr[:min_length] for arr in audio_arrays]
-        
-        # 混合音频
-        mixed = np.mean(audio_arrays, axis=0, dtype=np.float32)
-        
-        # 正则化以防止溢出
-        if len(audio_arrays) > 1:
-            mixed = mixed * (0.7 / len(audio_arrays))
-            
-        # 转换回16位整数
-        mixed = np.clip(mixed, np.iinfo(np.int16).min, np.iinfo(np.int16).max)
-        mixed = mixed.astype(np.int16)
-        
-        return mixed.tobytes()
\ No newline at end of file
+import time
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from AudioCodec import PCM16, CodecSet
+from AudioResampler import StreamFormatAdapter, needs_conversion
+from config import (CHUNK, RATE, JITTER_BUFFER_FRAMES, JITTER_PREFILL_FRAMES, JITTER_EXPIRY, AUDIO_MIX_MINUS,
+                    ACTIVE_SPEAKER_COUNT, VAD_THRESHOLD, VAD_HANGOVER_FRAMES)
+
+# 每个混音周期的时长（秒），与客户端采集的一个CHUNK对应
+FRAME_DURATION = CHUNK / RATE
+
+INT16_MIN = np.iinfo(np.int16).min
+INT16_MAX = np.iinfo(np.int16).max
+
+
+class AudioRingBuffer:
+    """会议级的预分配音频环形缓冲区
+
+    一个固定容量的int16矩阵 [参与者槽位, 缓冲深度, CHUNK]，每个参与者占用一个槽位，
+    帧按 seq % 深度 写入对应位置。收到的数据通过memoryview直接复制进矩阵，
+    混音时直接读取矩阵中的行，音频路径上不再为每个数据包分配新的对象。
+    """
+    def __init__(self, capacity: int, depth: int = JITTER_BUFFER_FRAMES):
+        self.capacity = capacity
+        self.depth = depth
+        self.samples = np.zeros((capacity, depth, CHUNK), dtype=np.int16)
+        self.seqs = np.full((capacity, depth), -1, dtype=np.int64)  # -1 表示该位置为空
+        self.arrivals = np.zeros((capacity, depth), dtype=np.float64)
+        self._free_slots = list(range(capacity - 1, -1, -1))
+
+    def acquire_slot(self) -> Optional[int]:
+        """分配一个空闲槽位，已满时返回None"""
+        if not self._free_slots:
+            return None
+        slot = self._free_slots.pop()
+        self.seqs[slot] = -1
+        return slot
+
+    def release_slot(self, slot: int):
+        """归还槽位"""
+        self.seqs[slot] = -1
+        self._free_slots.append(slot)
+
+
+class JitterBuffer:
+    """单个用户的抖动缓冲区
+
+    按序号缓存音频帧，每个混音周期取出一帧；迟到、过期的帧会被丢弃，
+    缺失的帧视为静音，而不是重复使用上一帧。数据存放在AudioRingBuffer的一个槽位中。
+    """
+    def __init__(self, ring: AudioRingBuffer, slot: int, prefill=JITTER_PREFILL_FRAMES, expiry=JITTER_EXPIRY):
+        self.slot = slot
+        self.max_frames = ring.depth
+        self.prefill = prefill
+        self.expiry = expiry
+        # 指向环形缓冲区中本槽位的视图
+        self.samples = ring.samples[slot]
+        self.seqs = ring.seqs[slot]
+        self.arrivals = ring.arrivals[slot]
+        self.next_seq: Optional[int] = None  # 下一次要播放的序号，None表示尚未开始/需要重新同步
+        self.last_seq: Optional[int] = None  # 最近收到的序号，用于为没有序号的旧客户端补齐
+        self.last_arrival = 0.0
+        self.silent = False  # 客户端处于静音（DTX）状态，缺帧不计为丢包
+
+        # 统计信息
+        self.late_frames = 0
+        self.expired_frames = 0
+        self.missing_frames = 0
+
+    def mark_silent(self, now: Optional[float] = None):
+        """收到客户端的静音保活标记"""
+        self.silent = True
+        self.last_arrival = time.monotonic() if now is None else now
+
+    def push(self, audio_data, seq: Optional[int] = None, now: Optional[float] = None):
+        """放入一帧音频"""
+        now = time.monotonic() if now is None else now
+        if seq is None:
+            seq = 0 if self.last_seq is None else self.last_seq + 1
+        self.last_seq = seq
+        self.last_arrival = now
+        self.silent = False
+
+        if self.next_seq is not None:
+            if seq < self.next_seq:
+                # 已经错过播放时间的迟到帧
+                self.late_frames += 1
+                return
+            if seq - self.next_seq >= self.max_frames:
+                # 序号大幅跳跃（例如客户端重启），重新同步
+                self.seqs[:] = -1
+                self.next_seq = None
+
+        pos = seq % self.max_frames
+        if self.seqs[pos] >= 0 and self.seqs[pos] != seq:
+            # 覆盖了一个未被播放的旧帧，缓冲区深度即延迟上限
+            self.expired_frames += 1
+
+        # 通过memoryview直接把数据复制进预分配的矩阵（解码后的数据已是int16数组）
+        if isinstance(audio_data, np.ndarray):
+            samples = audio_data
+        else:
+            samples = np.frombuffer(memoryview(audio_data), dtype=np.int16, count=len(audio_data) // 2)
+        count = min(len(samples), CHUNK)
+        row = self.samples[pos]
+        row[:count] = samples[:count]
+        row[count:] = 0
+        self.seqs[pos] = seq
+        self.arrivals[pos] = now
+
+    def pop(self, now: Optional[float] = None) -> Optional[np.ndarray]:
+        """取出当前周期的一帧（环形缓冲区中的一行），没有可用数据时返回None（静音）
+
+        返回的是缓冲区的视图，只在下一次push覆盖该位置之前有效。
+        """
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+
+        if self.next_seq is None:
+            # 等待预填充完成后再开始播放，吸收突发到达的抖动
+            valid = self.seqs >= 0
+            if np.count_nonzero(valid) < self.prefill:
+                return None
+            self.next_seq = int(self.seqs[valid].min())
+
+        pos = self.next_seq % self.max_frames
+        found = self.seqs[pos] == self.next_seq
+        self.next_seq += 1
+        if not found:
+            if not self.silent:
+                self.missing_frames += 1
+            if not (self.seqs >= 0).any():
+                # 缓冲区已空，下次收到数据时重新预填充
+                self.next_seq = None
+            return None
+        self.seqs[pos] = -1
+        return self.samples[pos]
+
+    def _expire(self, now):
+        """丢弃在缓冲区中停留过久的帧"""
+        expired = (self.seqs >= 0) & (now - self.arrivals > self.expiry)
+        if expired.any():
+            self.seqs[expired] = -1
+            self.expired_frames += int(np.count_nonzero(expired))
+
+    def is_idle(self, now: Optional[float] = None) -> bool:
+        """长时间没有收到数据"""
+        now = time.monotonic() if now is None else now
+        return not (self.seqs >= 0).any() and now - self.last_arrival > self.expiry
+
+
+class MixMatrix:
+    """预分配的混音矩阵
+
+    可以一次处理多组（多个会议的）音频帧：所有帧按组依次写入同一个int32矩阵，
+    用分段求和得到每组的总和，再减去每一行得到每个人的N-1混音。
+    参与者增多时按需扩容，之后不再为每个周期分配新的数组。
+    """
+    def __init__(self):
+        self._capacity = 0
+        self._group_capacity = 0
+        self._frames = np.zeros((0, CHUNK), dtype=np.int32)
+        self._personal = np.zeros((0, CHUNK), dtype=np.int32)
+        self._personal_out = np.zeros((0, CHUNK), dtype=np.int16)
+        self._totals = np.zeros((0, CHUNK), dtype=np.int32)
+        self._totals_out = np.zeros((0, CHUNK), dtype=np.int16)
+
+    def _ensure_capacity(self, rows: int, groups: int):
+        """保证预分配矩阵至少能容纳rows个参与者、groups个会议"""
+        if rows > self._capacity:
+            capacity = max(rows, self._capacity * 2, 4)
+            self._frames = np.zeros((capacity, CHUNK), dtype=np.int32)
+            self._personal = np.zeros((capacity, CHUNK), dtype=np.int32)
+            self._personal_out = np.zeros((capacity, CHUNK), dtype=np.int16)
+            self._capacity = capacity
+        if groups > self._group_capacity:
+            group_capacity = max(groups, self._group_capacity * 2, 4)
+            self._totals = np.zeros((group_capacity, CHUNK), dtype=np.int32)
+            self._totals_out = np.zeros((group_capacity, CHUNK), dtype=np.int16)
+            self._group_capacity = group_capacity
+
+    def mix_minus(self, groups: List[Dict[str, np.ndarray]]) -> List[Tuple[bytes, Dict[str, bytes]]]:
+        """一次向量化计算所有组的总混音和每个参与者的N-1混音
+
+        Args:
+            groups: 每个会议本周期的帧 {user_id: 长度为CHUNK的int16数组}，每组至少一帧
+
+        Returns:
+            与groups一一对应的 (total, personal) 列表：total为该组所有人的混音
+            （给没有发言的听众），personal为{user_id: 不含自己的混音}，
+            组内只有一个人发言时其混音为b''
+        """
+        if not groups:
+            return []
+
+        counts = [len(frames) for frames in groups]
+        rows = sum(counts)
+        self._ensure_capacity(rows, len(groups))
+        matrix = self._frames[:rows]
+        row_index = 0
+        for frames in groups:
+            for samples in frames.values():
+                matrix[row_index] = samples
+                row_index += 1
+
+        # 每组的总和只计算一次（分段求和）
+        offsets = np.cumsum([0] + counts[:-1])
+        totals = self._totals[:len(groups)]
+        np.add.reduceat(matrix, offsets, axis=0, out=totals)
+
+        # 每个人的混音 = 所在组的总和 - 自己
+        personal = self._personal[:rows]
+        np.take(totals, np.repeat(np.arange(len(groups)), counts), axis=0, out=personal)
+        np.subtract(personal, matrix, out=personal)
+        np.clip(personal, INT16_MIN, INT16_MAX, out=personal)
+        personal_out = self._personal_out[:rows]
+        personal_out[:] = personal
+
+        np.clip(totals, INT16_MIN, INT16_MAX, out=totals)
+        totals_out = self._totals_out[:len(groups)]
+        totals_out[:] = totals
+
+        # 按组拆分结果
+        results = []
+        row_index = 0
+        for group_index, frames in enumerate(groups):
+            if len(frames) == 1:
+                # 唯一的发言者听不到任何其他人
+                mixes = {user_id: b'' for user_id in frames}
+            else:
+                mixes = {user_id: personal_out[row_index + i].tobytes() for i, user_id in enumerate(frames)}
+            row_index += len(frames)
+            results.append((totals_out[group_index].tobytes(), mixes))
+        return results
+
+
+class SpeakerDetector:
+    """基于帧能量的发言检测与活跃发言者排序
+
+    每帧计算一次RMS能量并做指数平滑；能量超过阈值即视为在说话，
+    低于阈值后仍保持VAD_HANGOVER_FRAMES帧，避免句尾被截断。
+    只有排名前max_speakers的发言者会参与混音。
+    """
+    def __init__(self, max_speakers=ACTIVE_SPEAKER_COUNT, threshold=VAD_THRESHOLD,
+                 hangover=VAD_HANGOVER_FRAMES, smoothing=0.3):
+        self.max_speakers = max_speakers
+        self.threshold = threshold
+        self.hangover = hangover
+        self.smoothing = smoothing
+        self.levels: Dict[str, float] = {}  # 平滑后的能量
+        self.hold: Dict[str, int] = {}  # 剩余的保持帧数
+        self.active_speakers: List[str] = []  # 按能量从高到低排序
+        self.changed = False  # 活跃发言者列表自上次读取后是否发生变化
+
+    def update(self, frames: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """根据本周期的帧更新发言状态，返回只包含活跃发言者的帧"""
+        if frames:
+            # 一次计算所有帧的RMS能量
+            stacked = np.stack(list(frames.values()))
+            rms = np.sqrt(np.mean(np.square(stacked, dtype=np.float32), axis=1))
+        else:
+            rms = ()
+        energies = dict(zip(frames, rms))
+
+        for user_id in list(self.levels):
+            if user_id not in energies:
+                # 没有收到帧的用户视为静音
+                energies[user_id] = 0.0
+        for user_id, energy in energies.items():
+            level = self.levels.get(user_id, 0.0)
+            level += self.smoothing * (float(energy) - level)
+            self.levels[user_id] = level
+            if energy >= self.threshold:
+                self.hold[user_id] = self.hangover
+            elif self.hold.get(user_id, 0) > 0:
+                self.hold[user_id] -= 1
+
+        speaking = [user_id for user_id, hold in self.hold.items() if hold > 0]
+        speaking.sort(key=lambda user_id: self.levels[user_id], reverse=True)
+        speakers = speaking[:self.max_speakers]
+        if speakers != self.active_speakers:
+            if set(speakers) != set(self.active_speakers) or speakers[:1] != self.active_speakers[:1]:
+                # 只有成员或主发言者变化才通知，避免排名抖动产生大量事件
+                self.changed = True
+            self.active_speakers = speakers
+
+        return {user_id: frames[user_id] for user_id in speakers if user_id in frames}
+
+    def remove(self, user_id: str):
+        """移除离开的用户"""
+        self.levels.pop(user_id, None)
+        self.hold.pop(user_id, None)
+        if user_id in self.active_speakers:
+            self.active_speakers.remove(user_id)
+            self.changed = True
+
+    def pop_change(self) -> Optional[List[str]]:
+        """如果活跃发言者发生变化，返回新的列表并清除变化标记"""
+        if not self.changed:
+            return None
+        self.changed = False
+        return list(self.active_speakers)
+
+
+class AudioMixer:
+    def __init__(self, capacity: int = 10, mix_minus: bool = AUDIO_MIX_MINUS):
+        self.ring = AudioRingBuffer(capacity)
+        self.jitter_buffers: Dict[str, JitterBuffer] = {}
+        self.tick_seq = 0  # 混音周期序号，没有输出的周期也计数，接收端按它换算播放时间
+        self._last_tick: Optional[float] = None  # 上一个周期的计划时间
+        self.mix_minus = mix_minus
+        self.speakers = SpeakerDetector()
+        self.decoders: Dict[str, CodecSet] = {}  # 每个发言者上行流的解码器
+        self.adapters: Dict[str, StreamFormatAdapter] = {}  # 采集格式与会议格式不同的流的重采样器
+        self.encoders: Dict[str, CodecSet] = {}  # 每个发言者个人混音的编码器
+        self.total_encoders = CodecSet()  # 完整混音的编码器，所有听众共享
+        self._matrix = MixMatrix()  # 单独混音时使用，批量混音由MixScheduler负责
+
+    def add_audio_stream(self, user_id: str, audio_data: bytes, seq: Optional[int] = None, codec_id: int = PCM16,
+                         audio_format: Optional[Tuple[int, int, int]] = None):
+        """解码用户的音频帧，转换为会议格式后放入抖动缓冲区
+
+        Args:
+            audio_format: 客户端注册时声明的采集格式 (rate, channels, chunk)，None表示与会议格式相同
+        """
+        if user_id not in self.jitter_buffers:
+            slot = self.ring.acquire_slot()
+            if slot is None:
+                print(f"Audio mixer is full, dropping audio from {user_id}")
+                return
+            self.jitter_buffers[user_id] = JitterBuffer(self.ring, slot)
+            if audio_format:
+                rate, channels, chunk = audio_format
+                self.decoders[user_id] = CodecSet(rate, channels, chunk)
+                if needs_conversion(rate, channels):
+                    self.adapters[user_id] = StreamFormatAdapter(rate, channels)
+            else:
+                self.decoders[user_id] = CodecSet()
+        samples = self.decoders[user_id].decode(codec_id, audio_data)
+        if user_id in self.adapters:
+            samples = self.adapters[user_id].process(samples)
+            if samples is None:
+                return
+        self.jitter_buffers[user_id].push(samples, seq)
+
+    def remove_audio_stream(self, user_id: str):
+        """移除用户的音频流"""
+        if user_id in self.jitter_buffers:
+            self.ring.release_slot(self.jitter_buffers[user_id].slot)
+            del self.jitter_buffers[user_id]
+        self.decoders.pop(user_id, None)
+        self.adapters.pop(user_id, None)
+        self.encoders.pop(user_id, None)
+        self.speakers.remove(user_id)
+
+    def mark_silent(self, user_id: str):
+        """用户进入静音（DTX），之后没有收到的帧都按静音处理"""
+        if user_id in self.jitter_buffers:
+            self.jitter_buffers[user_id].mark_silent()
+
+    def pull_frames(self) -> Dict[str, np.ndarray]:
+        """从每个用户的抖动缓冲区取出本周期的一帧，缺失的用户不参与混音
+
+        返回的数组是环形缓冲区的视图，需要在下一次add_audio_stream之前完成混音。
+        """
+        now = time.monotonic()
+        frames = {}
+        for user_id, buffer in self.jitter_buffers.items():
+            samples = buffer.pop(now)
+            if samples is not None:
+                frames[user_id] = samples
+        return frames
+
+    def pull_speaker_frames(self) -> Dict[str, np.ndarray]:
+        """取出本周期的帧，并只保留排名前N的活跃发言者"""
+        return self.speakers.update(self.pull_frames())
+
+    def mix_audio(self, frames: Dict[str, np.ndarray]) -> bytes:
+        """混合给定的音频帧：直接相加后限幅，与mix-minus的增益规则相同，
+        同一个人的音量不随模式和自己是否在发言变化"""
+        if not frames:
+            return b''
+
+        # 混合音频（所有帧长度均为CHUNK）
+        mixed = np.sum(list(frames.values()), axis=0, dtype=np.int32)
+
+        # 转换回16位整数
+        mixed = np.clip(mixed, INT16_MIN, INT16_MAX)
+        mixed = mixed.astype(np.int16)
+
+        return mixed.tobytes()
+
+    def mix_minus_audio(self, frames: Dict[str, np.ndarray]) -> Tuple[bytes, Dict[str, bytes]]:
+        """一次向量化计算所有参与者的N-1混音
+
+        所有帧写入同一个int32矩阵，先求一次总和，再减去每个人自己的那一行，
+        得到每个人听到的混音（不包含自己的声音）。
+
+        Returns:
+            (total, personal): total为所有人的混音（给没有发言的听众），
+            personal为{user_id: 不含自己的混音}，只有一个人发言时其混音为b''
+        """
+        if not frames:
+            return b'', {}
+        return self._matrix.mix_minus([frames])[0]
+
+    def mix_tick(self, tick_time: Optional[float] = None) -> Tuple[bytes, Dict[str, bytes]]:
+        """执行一个混音周期：每个用户最多取一帧
+
+        Returns:
+            (total, personal): 所有人的混音，以及每个发言者的个人混音
+            （不使用mix-minus时为b''，发言者不会听到包含自己声音的完整混音）
+        """
+        frames = self.pull_speaker_frames()
+        if self.mix_minus:
+            total, personal = self.mix_minus_audio(frames)
+        else:
+            total, personal = self.mix_audio(frames), dict.fromkeys(frames, b'')
+        return self.finish_tick(total, personal, tick_time)
+
+    def finish_tick(self, total: bytes, personal: Dict[str, bytes],
+                    tick_time: Optional[float] = None) -> Tuple[bytes, Dict[str, bytes]]:
+        """记录一个周期的输出
+
+        静音周期也推进序号，否则接收端补偿一帧后会把之后的真实帧当作迟到帧丢弃。
+        tick_time为本周期的计划时间：混音循环空闲停止后重新启动时，按经过的周期数推进序号，
+        使序号始终与时间成正比。
+        """
+        if tick_time is not None and self._last_tick is not None:
+            self.tick_seq += max(1, round((tick_time - self._last_tick) / FRAME_DURATION))
+        else:
+            self.tick_seq += 1
+        if tick_time is not None:
+            self._last_tick = tick_time
+        return total, personal
+
+    def encode_tick(self, total: bytes, personal: Dict[str, bytes],
+                    recipients: Dict[str, int]) -> Dict[str, Tuple[int, bytes]]:
+        """把一个周期的混音结果按每个接收者的编解码器编码
+
+        完整混音对每种编解码器只编码一次，由所有听众共享；个人混音各自编码。
+
+        Args:
+            recipients: {user_id: codec_id}
+
+        Returns:
+            {user_id: (codec_id, payload)}，没有需要收听内容的用户不会出现在结果中
+        """
+        encoded = {}
+        total_payloads = {}
+        for user_id, codec_id in recipients.items():
+            if user_id in personal:
+                pcm = personal[user_id]
+                if not pcm:
+                    continue
+                if user_id not in self.encoders:
+                    self.encoders[user_id] = CodecSet()
+                encoded[user_id] = (codec_id, self.encoders[user_id].encode(codec_id, pcm))
+            elif total:
+                if codec_id not in total_payloads:
+                    total_payloads[codec_id] = self.total_encoders.encode(codec_id, total)
+                encoded[user_id] = (codec_id, total_payloads[codec_id])
+        return encoded
+
+    def is_idle(self) -> bool:
+        """所有用户都长时间没有音频输入"""
+        now = time.monotonic()
+        return all(buffer.is_idle(now) for buffer in self.jitter_buffers.values())
+
+
+class MixScheduler:
+    """跨会议的批量混音调度器
+
+    每个音频周期从所有活跃会议的混音器各取一帧，把所有会议的帧打包进同一个矩阵，
+    用一次向量化运算（分段求和）完成所有mix-minus会议的混音，再把结果分发回各会议。
+    """
+    def __init__(self):
+        self._matrix = MixMatrix()
+
+    def mix_all(self, mixers: Dict[str, AudioMixer],
+                tick_time: Optional[float] = None) -> Dict[str, Tuple[bytes, Dict[str, bytes]]]:
+        """为所有会议执行一个混音周期，tick_time为本周期的计划时间
+
+        Returns:
+            {conf_id: (total, personal)}，本周期没有任何音频的会议不会出现在结果中
+        """
+        results = {}
+        batch_ids = []
+        batch_frames = []
+        for conf_id, mixer in mixers.items():
+            frames = mixer.pull_speaker_frames()
+            if not frames:
+                # 没有音频的周期也要推进序号
+                mixer.finish_tick(b'', {}, tick_time)
+                continue
+            if mixer.mix_minus:
+                batch_ids.append(conf_id)
+                batch_frames.append(frames)
+            else:
+                results[conf_id] = mixer.finish_tick(mixer.mix_audio(frames), dict.fromkeys(frames, b''), tick_time)
+
+        for conf_id, (total, personal) in zip(batch_ids, self._matrix.mix_minus(batch_frames)):
+            results[conf_id] = mixers[conf_id].finish_tick(total, personal, tick_time)
+        return results
@@ -0,0 +1,171 @@
+import math
+import threading
+import time
+import numpy as np
+from typing import Dict, Optional
+from config import CHUNK, RATE, PLAYBACK_MIN_FRAMES, PLAYBACK_MAX_FRAMES, PLC_MAX_FRAMES, PLC_FADE
+
+# 每帧的时长（秒），与服务器混音周期一致
+FRAME_DURATION = CHUNK / RATE
+
+
+class AudioPlayer:
+    """客户端播放抖动缓冲区
+
+    网络线程（asyncio）只负责把收到的帧按序号放入缓冲区，由独立的播放线程按声卡时钟
+    阻塞写入输出流。缓冲深度根据测得的到达抖动自适应调整；丢失或迟到的帧用上一帧
+    逐渐衰减的副本补偿，连续丢失过多时输出静音并重新缓冲。
+    """
+    def __init__(self, stream, min_depth=PLAYBACK_MIN_FRAMES, max_depth=PLAYBACK_MAX_FRAMES,
+                 max_conceal=PLC_MAX_FRAMES, fade=PLC_FADE):
+        self.stream = stream
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.max_conceal = max_conceal
+        self.fade = fade
+
+        self.frames: Dict[int, np.ndarray] = {}  # {seq: int16 samples}
+        self.cond = threading.Condition()
+        self.next_seq: Optional[int] = None
+        self.playing = False  # False表示正在（重新）缓冲
+        self.target_depth = min_depth
+        self.jitter = 0.0  # 到达抖动估计（秒），参考RFC 3550
+        self._last_transit: Optional[float] = None
+        self._last_seq: Optional[int] = None
+        self._last_frame: Optional[np.ndarray] = None
+        self._concealed_run = 0
+
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+        # 统计信息
+        self.received_frames = 0
+        self.played_frames = 0
+        self.late_frames = 0
+        self.concealed_frames = 0
+        self.dropped_frames = 0
+        self.underruns = 0
+
+    def start(self):
+        """启动播放线程"""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='audio-playback', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止播放线程并清空缓冲区"""
+        self._running = False
+        with self.cond:
+            self.frames.clear()
+            self.playing = False
+            self.cond.notify()
+        if self._thread:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def push(self, pcm: bytes, seq: Optional[int] = None):
+        """放入收到的一帧（在网络线程中调用，不会阻塞）"""
+        now = time.monotonic()
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        with self.cond:
+            if seq is None:
+                seq = 0 if self._last_seq is None else self._last_seq + 1
+            self._last_seq = seq
+            self.received_frames += 1
+            self._update_jitter(seq, now)
+
+            if self.playing:
+                if seq < self.next_seq:
+                    # 已经错过播放时间
+                    self.late_frames += 1
+                    return
+                if seq - self.next_seq > self.max_depth * 4:
+                    # 序号大幅跳跃（例如服务器重启了混音），重新缓冲
+                    self.frames.clear()
+                    self.playing = False
+
+            self.frames[seq] = samples
+            self.cond.notify()
+
+    def _update_jitter(self, seq, now):
+        """根据到达时间与序号对应的理论时间之差估计抖动，并调整目标缓冲深度"""
+        transit = now - seq * FRAME_DURATION
+        if self._last_transit is not None:
+            delta = abs(transit - self._last_transit)
+            if delta < 1.0:  # 忽略静音间隔或序号重置造成的跳变
+                self.jitter += (delta - self.jitter) / 16
+        self._last_transit = transit
+        depth = math.ceil(3 * self.jitter / FRAME_DURATION) + 1
+        self.target_depth = max(self.min_depth, min(self.max_depth, depth))
+
+    def _conceal(self) -> np.ndarray:
+        """丢包补偿：重复上一帧并逐渐衰减，超过上限后输出静音"""
+        self._concealed_run += 1
+        self.concealed_frames += 1
+        if self._last_frame is None or self._concealed_run > self.max_conceal:
+            return np.zeros(CHUNK, dtype=np.int16)
+        gain = self.fade ** self._concealed_run
+        return (self._last_frame * gain).astype(np.int16)
+
+    def _next_frame(self) -> Optional[np.ndarray]:
+        """取出下一帧要播放的数据，需要等待缓冲时返回None"""
+        if not self.playing:
+            if len(self.frames) < self.target_depth:
+                return None
+            self.next_seq = min(self.frames)
+            self.playing = True
+
+        # 缓冲超过目标深度太多时丢弃最旧的帧，使播放延迟回落
+        while len(self.frames) > self.target_depth + 2:
+            oldest = min(self.frames)
+            del self.frames[oldest]
+            self.dropped_frames += 1
+            self.next_seq = max(self.next_seq, oldest + 1)
+
+        frame = self.frames.pop(self.next_seq, None)
+        self.next_seq += 1
+        if frame is not None:
+            self._concealed_run = 0
+            self._last_frame = frame
+            self.played_frames += 1
+            return frame
+
+        if not self.frames and self._concealed_run >= self.max_conceal:
+            # 断流：停止播放，等待重新缓冲
+            self.playing = False
+            self.underruns += 1
+            self._last_frame = None
+            self._concealed_run = 0
+            return None
+        return self._conceal()
+
+    def _run(self):
+        while self._running:
+            with self.cond:
+                frame = self._next_frame()
+                if frame is None:
+                    self.cond.wait(timeout=FRAME_DURATION)
+                    continue
+            try:
+                # 阻塞写入，由声卡时钟控制播放节奏
+                self.stream.write(frame.tobytes())
+            except Exception as e:
+                print(f"Error writing audio output: {e}")
+                time.sleep(FRAME_DURATION)
+
+    def stats(self):
+        """缓冲深度与丢包统计"""
+        with self.cond:
+            return {
+                'depth': len(self.frames),
+                'target_depth': self.target_depth,
+                'jitter_ms': round(self.jitter * 1000, 1),
+                'received': self.received_frames,
+                'played': self.played_frames,
+                'late': self.late_frames,
+                'concealed': self.concealed_frames,
+                'dropped': self.dropped_frames,
+                'underruns': self.underruns,
+            }
@@ -0,0 +1,106 @@
+import math
+import numpy as np
+from functools import lru_cache
+from typing import Optional
+from config import CHUNK, RATE, CHANNELS, RESAMPLER_TAPS_PER_PHASE
+
+
+@lru_cache(maxsize=16)
+def _polyphase_filter(up: int, down: int, taps_per_phase: int) -> np.ndarray:
+    """设计低通滤波器并拆分为多相形式，按(up, down)缓存，所有音频流共享
+
+    Returns:
+        形状为 [up, taps_per_phase] 的系数矩阵，第p行是第p个相位的子滤波器
+    """
+    length = up * taps_per_phase
+    # 截止频率取两个采样率中较低者的奈奎斯特频率（相对于上采样后的采样率）
+    cutoff = 0.5 / max(up, down) * 0.9
+    n = np.arange(length) - (length - 1) / 2
+    prototype = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(length, 8.0)
+    prototype *= up / prototype.sum()  # 补偿插零带来的增益损失
+    # h_poly[p, k] = h[p + k * up]
+    return prototype.reshape(taps_per_phase, up).T.astype(np.float32).copy()
+
+
+class PolyphaseResampler:
+    """向量化的有理数倍多相重采样器
+
+    每个音频流一个实例，保存跨数据块的滤波器历史和相位，使分块处理的结果
+    与一次性处理整段信号相同。滤波器系数按采样率比例缓存共享。
+    """
+    def __init__(self, from_rate: int, to_rate: int, taps_per_phase: int = RESAMPLER_TAPS_PER_PHASE):
+        divisor = math.gcd(from_rate, to_rate)
+        self.up = to_rate // divisor
+        self.down = from_rate // divisor
+        self.taps = taps_per_phase
+        self.filter = _polyphase_filter(self.up, self.down, taps_per_phase)
+        self._history = np.zeros(taps_per_phase - 1, dtype=np.float32)
+        self._offsets = np.arange(taps_per_phase)
+        self._position = 0  # 下一个输出样本在本块中的位置（以1/up个输入样本为单位）
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        """重采样一块单声道数据，返回float32数组（长度随相位略有变化）"""
+        count = len(samples)
+        extended = np.concatenate((self._history, samples.astype(np.float32)))
+
+        # 本块内所有输出样本对应的上采样位置
+        end = count * self.up
+        positions = np.arange(self._position, end, self.down)
+        if len(positions):
+            bases = positions // self.up
+            phases = positions % self.up
+            # 一次取出所有输出需要的输入窗口 [输出数, 抽头数]，与对应相位的系数相乘求和
+            windows = extended[(bases + self.taps - 1)[:, None] - self._offsets[None, :]]
+            output = np.einsum('ij,ij->i', windows, self.filter[phases])
+            self._position = int(positions[-1]) + self.down - end
+        else:
+            output = np.zeros(0, dtype=np.float32)
+            self._position -= end
+
+        self._history = extended[len(extended) - (self.taps - 1):]
+        return output
+
+
+class StreamFormatAdapter:
+    """把一个音频流转换为会议格式（RATE，单声道，每帧CHUNK个采样）
+
+    先混缩为单声道，再用多相重采样器转换采样率，最后通过一个小的FIFO
+    重新切分为CHUNK长度的帧，使每个输入数据包仍然对应一个输出帧。
+    """
+    def __init__(self, rate: int, channels: int, to_rate: int = RATE):
+        self.channels = max(1, channels)
+        self.resampler = PolyphaseResampler(rate, to_rate) if rate != to_rate else None
+        self._fifo = np.zeros(0, dtype=np.float32)
+        # 预留少量采样，吸收非整数倍采样率下每块输出长度±1的波动
+        self._margin = CHUNK // 8
+        self._primed = False
+
+    def process(self, samples: np.ndarray) -> Optional[np.ndarray]:
+        """转换一个数据包，返回一帧int16数据；仍在积累数据时返回None"""
+        if self.channels > 1:
+            usable = len(samples) - len(samples) % self.channels
+            mono = samples[:usable].reshape(-1, self.channels).mean(axis=1, dtype=np.float32)
+        else:
+            mono = samples.astype(np.float32)
+        if self.resampler:
+            mono = self.resampler.process(mono)
+
+        self._fifo = np.concatenate((self._fifo, mono))
+        if not self._primed:
+            if len(self._fifo) < CHUNK + self._margin:
+                return None
+            self._primed = True
+        if len(self._fifo) < CHUNK:
+            return None
+        if len(self._fifo) > 2 * CHUNK + self._margin:
+            # 积压过多（时钟漂移），丢弃最旧的数据
+            self._fifo = self._fifo[len(self._fifo) - CHUNK - self._margin:]
+
+        frame = np.clip(self._fifo[:CHUNK], -32768, 32767).astype(np.int16)
+        self._fifo = self._fifo[CHUNK:]
+        return frame
+
+
+def needs_conversion(rate: int, channels: int) -> bool:
+    """该格式是否与会议格式不同"""
+    return rate != RATE or channels != CHANNELS
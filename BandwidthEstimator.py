@@ -0,0 +1,58 @@
+from collections import deque
+from typing import Optional
+from config import (BWE_INITIAL_BPS, BWE_MIN_BPS, BWE_MAX_BPS, BWE_DELAY_THRESHOLD, BWE_RTT_WINDOW,
+                    BWE_DECREASE, BWE_INCREASE)
+
+
+class BandwidthEstimator:
+    """单个接收者的下行带宽估计
+
+    基于延迟的拥塞控制：RTT探测包和媒体走同一个连接，排队延迟（平滑RTT减去窗口内最小RTT）
+    上升或者发送队列积压时，说明发送速度超过了链路容量，把估计值降到实际送达速率以下；
+    链路空闲时按比例缓慢上调，但不超过实际送达速率太多，避免应用本身发送不足时估计值虚高。
+    """
+    def __init__(self, initial=BWE_INITIAL_BPS, min_bps=BWE_MIN_BPS, max_bps=BWE_MAX_BPS):
+        self.estimate = initial  # bits/s
+        self.initial = initial
+        self.min_bps = min_bps
+        self.max_bps = max_bps
+        self.srtt: Optional[float] = None
+        self.min_rtt: Optional[float] = None
+        self._rtts = deque(maxlen=BWE_RTT_WINDOW)  # 窗口内最小值作为基准，路由变化后能恢复
+        self.delivery_rate = 0.0  # 最近一个周期的实际送达速率（bits/s）
+        self.overused = False
+
+    def on_rtt(self, rtt: float):
+        """记录一次RTT探测结果（秒）"""
+        self._rtts.append(rtt)
+        self.min_rtt = min(self._rtts)
+        self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) / 8
+
+    @property
+    def queuing_delay(self) -> float:
+        if self.srtt is None:
+            return 0.0
+        return max(0.0, self.srtt - self.min_rtt)
+
+    def update(self, delivered_bytes: float, interval: float, congested: bool = False) -> float:
+        """每个周期调用一次，delivered_bytes为本周期实际写出的字节数，返回新的估计值"""
+        self.delivery_rate = delivered_bytes * 8 / interval if interval > 0 else 0.0
+        delay = self.queuing_delay
+        self.overused = congested or delay > BWE_DELAY_THRESHOLD
+        if self.overused:
+            # 过载：降到实际送达速率以下，让积压的数据排空
+            self.estimate = min(self.estimate, max(self.delivery_rate, self.min_bps)) * BWE_DECREASE
+        elif delay < BWE_DELAY_THRESHOLD / 2:
+            ceiling = max(self.delivery_rate * 1.5, self.initial)
+            self.estimate = min(self.estimate * BWE_INCREASE, max(ceiling, self.estimate))
+        self.estimate = max(self.min_bps, min(self.max_bps, self.estimate))
+        return self.estimate
+
+    def stats(self):
+        return {
+            'estimate_kbps': round(self.estimate / 1000),
+            'delivery_kbps': round(self.delivery_rate / 1000),
+            'srtt_ms': None if self.srtt is None else round(self.srtt * 1000, 1),
+            'queuing_ms': round(self.queuing_delay * 1000, 1),
+            'overused': self.overused,
+        }
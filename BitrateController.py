@@ -0,0 +1,107 @@
+import time
+from typing import Optional
+from PIL import Image
+from config import ABR_DECREASE, ABR_INCREASE_STEP, ABR_BACKLOG_HIGH, ABR_QUEUE_HIGH
+
+
+def _lerp(low, high, level):
+    return low + (high - low) * level
+
+
+class BitrateController:
+    """客户端自适应码率控制，摄像头和屏幕共享各一个
+
+    用一个0~1之间的档位同时决定JPEG质量、缩放比例和帧率（在配置的下限和上限之间线性变化）。
+    发送队列接近满、连接中上一帧还没有写出、或估算码率超过服务器下发的目标码率时按比例降档，
+    否则每帧小幅升档（AIMD），使码率贴近链路实际能承受的水平，而不是让帧在队列里堆积后被丢弃。
+    """
+    def __init__(self, profile: dict):
+        self.profile = profile
+        self.level = 1.0
+        self.target_bitrate: Optional[float] = None  # bits/s
+        self.frame_bytes = 0.0  # 编码后帧大小的滑动平均
+        self.backlog = 0  # 发送一帧时连接中尚未写出的数据包数
+        self._last_adjust = 0.0
+
+        # 统计信息
+        self.decreases = 0
+        self.dropped_frames = 0
+
+    @property
+    def quality(self) -> int:
+        return round(_lerp(self.profile['min_quality'], self.profile['max_quality'], self.level))
+
+    @property
+    def scale(self) -> float:
+        return _lerp(self.profile['min_scale'], self.profile['max_scale'], self.level)
+
+    @property
+    def fps(self) -> float:
+        return _lerp(self.profile['min_fps'], self.profile['max_fps'], self.level)
+
+    @property
+    def frame_interval(self) -> float:
+        return 1 / self.fps
+
+    @property
+    def bitrate(self) -> float:
+        """按当前帧大小和帧率估算的发送码率（bits/s）"""
+        return self.frame_bytes * 8 * self.fps
+
+    def set_target_bitrate(self, bps: Optional[float]):
+        self.target_bitrate = bps
+
+    def prepare(self, image: Image.Image) -> Image.Image:
+        """按当前缩放比例缩小待编码的图像"""
+        scale = self.scale
+        if scale >= 0.99:
+            return image
+        size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        return image.resize(size, Image.BILINEAR)
+
+    def on_frame_encoded(self, nbytes: int):
+        self.frame_bytes += (nbytes - self.frame_bytes) / 8 if self.frame_bytes else nbytes
+
+    def on_backlog(self, packets: int):
+        """发送一帧之前连接中尚未写出的数据包数
+
+        emit只是把数据包放入engineio的发送队列，立即返回，不能用发送耗时判断拥塞；
+        链路跟不上时上一帧的数据包还在队列中。
+        """
+        self.backlog = packets
+
+    def on_frame_dropped(self):
+        """发送队列已满，这一帧没有发送"""
+        self.dropped_frames += 1
+        self._decrease(ABR_DECREASE)
+
+    def update(self, queue_fullness: float):
+        """每采集一帧调用一次，queue_fullness为发送队列占用比例（0~1）"""
+        if queue_fullness >= ABR_QUEUE_HIGH or self.backlog > ABR_BACKLOG_HIGH:
+            self._decrease(ABR_DECREASE)
+        elif self.target_bitrate and self.bitrate > self.target_bitrate:
+            # 超出目标码率：按比例降档，一次最多降到ABR_DECREASE倍
+            self._decrease(max(ABR_DECREASE, self.target_bitrate / self.bitrate))
+        elif self.target_bitrate is None or self.bitrate * (1 + ABR_INCREASE_STEP) < self.target_bitrate:
+            self.level = min(1.0, self.level + ABR_INCREASE_STEP)
+
+    def _decrease(self, factor: float):
+        # 降档后等待一个帧间隔再次降档，给队列排空的时间
+        now = time.monotonic()
+        if now - self._last_adjust < self.frame_interval:
+            return
+        self._last_adjust = now
+        self.level = max(0.0, self.level * factor)
+        self.decreases += 1
+
+    def stats(self):
+        return {
+            'quality': self.quality,
+            'scale': round(self.scale, 2),
+            'fps': round(self.fps, 1),
+            'bitrate_kbps': round(self.bitrate / 1000),
+            'backlog': self.backlog,
+            'target_kbps': None if self.target_bitrate is None else round(self.target_bitrate / 1000),
+            'decreases': self.decreases,
+            'dropped': self.dropped_frames,
+        }
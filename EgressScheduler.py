@@ -0,0 +1,195 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+from config import EGRESS_QUEUE_LIMITS, EGRESS_STALE_AGE, EGRESS_POLL_INTERVAL, EGRESS_BURST
+
+# 发送优先级，数值越小越先发送
+AUDIO = 0
+CONTROL = 1
+VIDEO = 2
+SCREEN = 3
+PRIORITY_NAMES = ('audio', 'control', 'video', 'screen')
+
+
+def transport_backlog(server, sid) -> int:
+    """连接的engineio发送队列中尚未写出的数据包数量，无法获取时返回0"""
+    try:
+        eio_sid = server.manager.eio_sid_from_sid(sid, '/')
+        return server.eio.sockets[eio_sid].queue.qsize()
+    except (AttributeError, KeyError, TypeError):
+        return 0
+
+
+def _message_size(data) -> int:
+    """估算一条消息的字节数，控制消息按固定大小计算"""
+    try:
+        return len(data) if isinstance(data, (bytes, bytearray, memoryview)) else 128
+    except TypeError:
+        return 128
+
+
+class EgressQueue:
+    """单个用户的下行发送调度器
+
+    每个优先级一个有界队列，严格按优先级发送：音频 > 控制 > 视频 > 屏幕共享。视频和屏幕
+    共享队列中每个发送者最多只有一帧，接收者跟不上时新帧直接替换还没发出的旧帧（保留
+    原来的排队位置），因此内存占用与会议人数成正比，而不是与积压时长成正比。底层连接
+    还有未写出的数据包或超出带宽预算（令牌桶，见set_rate）时暂停发送视频和屏幕共享，
+    期间新到的音频和控制消息仍可先发出；音频和控制消息不受预算限制，但占用预算。
+    积压按包数而不是字节数判断，一个视频帧可能有几十KB，所以默认只要有积压就暂停，
+    连接中最多只有一个视频帧。
+    """
+    def __init__(self, send: Callable[[str, object, str], Awaitable[None]],
+                 backlog: Optional[Callable[[str], int]] = None,
+                 limits=EGRESS_QUEUE_LIMITS, stale_after=EGRESS_STALE_AGE, max_backlog=0,
+                 latest_only=(VIDEO, SCREEN)):
+        self.send = send  # async send(event, data, connection)
+        self.backlog = backlog  # backlog(connection) -> 底层待写出的数据包数
+        self.limits = limits
+        self.stale_after = stale_after
+        self.max_backlog = max_backlog  # 底层待写出的数据包超过该数量时暂停视频和屏幕共享
+        self.latest_only = latest_only
+        # {key: (enqueued, event, data, connection, source)}，只保留最新帧的队列以发送者为key
+        self.queues = [OrderedDict() for _ in PRIORITY_NAMES]
+        self._keys = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        # 带宽预算（bits/s），None表示不限制；令牌以字节为单位，允许欠账发送一个大帧
+        self.rate: Optional[float] = None
+        self._tokens = 0.0
+        self._refilled = time.monotonic()
+
+        # 统计信息
+        self.bytes_sent = 0
+        self.mean_size = 0.0  # 消息大小的滑动平均，用于把积压的包数换算为字节数
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.dropped = [0] * len(PRIORITY_NAMES)  # 队列满、过期或被discard丢弃
+        self.replaced = [0] * len(PRIORITY_NAMES)  # 被同一发送者的新帧替换
+        self.lag = [0.0] * len(PRIORITY_NAMES)  # 排队时间的滑动平均（秒）
+        self.max_lag = [0.0] * len(PRIORITY_NAMES)
+
+    def put(self, priority: int, event: str, data, connection: str = 'main', source=None):
+        """加入一条待发送的消息，source为媒体帧的发送者"""
+        queue = self.queues[priority]
+        item = (time.monotonic(), event, data, connection, source)
+        if priority in self.latest_only and source is not None:
+            if source in queue:
+                self.replaced[priority] += 1
+            else:
+                self._make_room(priority)
+            queue[source] = item
+        else:
+            self._make_room(priority)
+            queue[next(self._keys)] = item
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def set_rate(self, bps: Optional[float]):
+        """设置下行带宽预算"""
+        self._refill()
+        self.rate = bps
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            burst = self.rate / 8 * EGRESS_BURST
+            self._tokens = min(burst, self._tokens + self.rate / 8 * (now - self._refilled))
+        self._refilled = now
+
+    def _make_room(self, priority):
+        queue = self.queues[priority]
+        limit = self.limits[priority]
+        if limit and len(queue) >= limit:
+            # 队列已满，最旧的消息已经过时
+            queue.popitem(last=False)
+            self.dropped[priority] += 1
+
+    def discard(self, priority: int, source):
+        """丢弃某个发送者尚未发出的帧（例如对方已经关闭视频）"""
+        queue = self.queues[priority]
+        for key in [key for key, item in queue.items() if item[4] == source]:
+            del queue[key]
+            self.dropped[priority] += 1
+
+    def close(self):
+        """停止发送并清空所有队列"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for queue in self.queues:
+            queue.clear()
+
+    def _next_priority(self) -> Optional[int]:
+        for priority, queue in enumerate(self.queues):
+            if queue:
+                return priority
+        return None
+
+    async def _run(self):
+        try:
+            while True:
+                priority = self._next_priority()
+                if priority is None:
+                    break
+                queue = self.queues[priority]
+                enqueued, event, data, connection, _ = next(iter(queue.values()))
+
+                if priority >= VIDEO:
+                    if time.monotonic() - enqueued > self.stale_after:
+                        queue.popitem(last=False)
+                        self.dropped[priority] += 1
+                        continue
+                    self._refill()
+                    wait = None
+                    if self.backlog and self.backlog(connection) > self.max_backlog:
+                        # 连接积压，等待写出
+                        wait = EGRESS_POLL_INTERVAL
+                    elif self.rate is not None and self._tokens < 0:
+                        # 超出带宽预算，等到令牌补足；同一发送者的新帧会替换这一帧
+                        wait = min(-self._tokens * 8 / self.rate, EGRESS_POLL_INTERVAL * 4)
+                    if wait is not None:
+                        # 期间到达的音频和控制消息会唤醒并插队
+                        self._wakeup.clear()
+                        try:
+                            await asyncio.wait_for(self._wakeup.wait(), wait)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+
+                queue.popitem(last=False)
+                lag = time.monotonic() - enqueued
+                self.lag[priority] += (lag - self.lag[priority]) / 8
+                self.max_lag[priority] = max(self.max_lag[priority], lag)
+                size = _message_size(data)
+                self._refill()
+                self._tokens -= size
+                try:
+                    await self.send(event, data, connection)
+                    self.sent[priority] += 1
+                    self.bytes_sent += size
+                    self.mean_size += (size - self.mean_size) / 16
+                except Exception as e:
+                    print(f"Error sending {PRIORITY_NAMES[priority]}: {e}")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    def stats(self):
+        """各优先级的排队、发送、丢弃数量和排队延迟"""
+        return {
+            name: {
+                'queued': len(self.queues[priority]),
+                'sent': self.sent[priority],
+                'dropped': self.dropped[priority],
+                'replaced': self.replaced[priority],
+                'lag_ms': round(self.lag[priority] * 1000, 1),
+                'max_lag_ms': round(self.max_lag[priority] * 1000, 1),
+            }
+            for priority, name in enumerate(PRIORITY_NAMES)
+        }
@@ -7,6 +7,10 @@ from util import *
 from conf_client import ConferenceClient
 from VideoManager import VideoGridManager
 from Controlbar import ControlBar
+from AudioPlayer import AudioPlayer
+from BitrateController import BitrateController
+from UIBridge import AsyncioThread, UIUpdateQueue
+from VideoDecoder import VideoDecoder
 import time
 class LoginFrame(ttk.Frame):
     pass
@@ -17,7 +21,7 @@ class ConferenceListFrame(ttk.Frame):
 class ConferenceFrame(ttk.Frame):
     pass
 class ConferenceGUI(tk.Tk):
-    def __init__(self, server_url, loop):
+    def __init__(self, server_url, loop=None):
         super().__init__()
         self.title("视频会议")
         self.minsize(800, 600)
@@ -27,16 +31,19 @@ class ConferenceGUI(tk.Tk):
         self.grid_rowconfigure(0, weight=1)
         
         self.server_url = server_url
-        self.loop = loop
+        # asyncio事件循环运行在独立线程中，网络事件通过界面更新队列交给Tk线程
+        self.async_thread = AsyncioThread(loop)
+        self.loop = self.async_thread.loop
+        self.ui_queue = UIUpdateQueue()
         self.client = ConferenceClient(server_url)
         self.current_frame = None
+        self._closed = False
         
         self.switch_frame(LoginFrame)
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
         
-        # 定期运行asyncio事件循环
-        self._schedule_asyncio_poll()
-        self._asyncio_poll_id = None
+        self.async_thread.start()
+        self._ui_poll_id = self.after(UI_FRAME_INTERVAL_MS, self._drain_ui_updates)
 
     def switch_frame(self, frame_class):
         new_frame = frame_class(self, self.client)
@@ -45,36 +52,40 @@ class ConferenceGUI(tk.Tk):
         self.current_frame = new_frame
         self.current_frame.grid(row=0, column=0, sticky='nsew')  # 使用grid而不是pack
 
-    def _schedule_asyncio_poll(self):
-        # print("Polling asyncio event loop...")
-        self.loop.call_soon(self.loop.stop)
-        self.loop.run_forever()
-        self.after(10, self._schedule_asyncio_poll)
+    def run_async(self, coro):
+        """在网络线程中运行协程（从Tk线程调用）"""
+        return self.async_thread.submit(coro)
 
-    def on_closing(self):
-        # 取消定时的 asyncio 轮询
-        if self._asyncio_poll_id is not None:
-            self.after_cancel(self._asyncio_poll_id)
-
-        # 创建一个任务来执行关闭操作
-        self.loop.create_task(self.shutdown())
-
-    async def shutdown(self):
-        # 先退出当前会议
-        if self.client.conference:
-            await self.client.leave_conference()
+    def post_ui(self, callback, *args, key=None):
+        """请求在Tk线程中执行界面更新（可在任意线程调用），相同key的更新只执行最新提交的一个"""
+        self.ui_queue.post(callback, *args, key=key)
 
-        # 然后断开连接
-        await self.client.disconnect()
+    def _drain_ui_updates(self):
+        """每个显示帧执行一次排队的界面更新"""
+        self.ui_queue.drain(stop=lambda: self._closed)
+        if not self._closed:
+            self._ui_poll_id = self.after(UI_FRAME_INTERVAL_MS, self._drain_ui_updates)
 
-        # 取消所有挂起的任务
-        tasks = [task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task(self.loop)]
-        for task in tasks:
-            task.cancel()
-        await asyncio.gather(*tasks, return_exceptions=True)
+    def on_closing(self):
+        # 在网络线程中执行关闭操作
+        self.run_async(self.shutdown())
 
-        # 停止事件循环并销毁GUI
-        self.loop.stop()
+    async def shutdown(self):
+        try:
+            # 先退出当前会议
+            if self.client.conference:
+                await self.client.leave_conference()
+
+            # 然后断开连接
+            await self.client.disconnect()
+        finally:
+            # 回到Tk线程销毁GUI，mainloop返回后再停止事件循环线程
+            self.post_ui(self.close_window)
+
+    def close_window(self):
+        self._closed = True
+        self.after_cancel(self._ui_poll_id)
+        print(f"UI update stats: {self.ui_queue.stats()}")
         self.destroy()
 class LoginFrame(ttk.Frame):
     def __init__(self, master, client):
@@ -100,16 +111,16 @@ class LoginFrame(ttk.Frame):
         login_button.grid(row=2, column=0, pady=20)
 
     def login_clicked(self):
-        self.master.loop.create_task(self.login())
-    
-    async def login(self):
         username = self.username_entry.get()
         if username:
-            self.client.username = username
-            print("Connecting to server...")
-            await self.client.connect()
-            print("Switching to conference list frame")
-            self.master.switch_frame(ConferenceListFrame)
+            self.master.run_async(self.login(username))
+    
+    async def login(self, username):
+        self.client.username = username
+        print("Connecting to server...")
+        await self.client.connect()
+        print("Switching to conference list frame")
+        self.master.post_ui(self.master.switch_frame, ConferenceListFrame)
 
 class ConferenceListFrame(ttk.Frame):
     def __init__(self, master, client):
@@ -151,13 +162,13 @@ class ConferenceListFrame(ttk.Frame):
         refresh_button = ttk.Button(button_frame, text="刷新列表", command=self.refresh_conferences)
         refresh_button.grid(row=0, column=1, padx=5)
         
-        self.master.loop.create_task(self.refresh_conferences_async())
+        self.master.run_async(self.refresh_conferences_async())
 
     def create_conference(self):
         dialog = CreateConferenceDialog(self.master, self.client)
         self.master.wait_window(dialog)
         if dialog.result:
-            self.master.loop.create_task(self._create_conference(dialog.result))
+            self.master.run_async(self._create_conference(dialog.result))
 
     async def _create_conference(self, conf_name):
         await self.client.create_conference(conf_name, self.client.username)
@@ -174,31 +185,33 @@ class ConferenceListFrame(ttk.Frame):
             # 立即加入会议
             await self.client.join_conference(created_conference.id, self.client.username)
             # 切换到会议界面
-            self.master.switch_frame(ConferenceFrame)
+            self.master.post_ui(self.master.switch_frame, ConferenceFrame)
         else:
             print("Error: Could not find newly created conference")
         # await self.refresh_conferences_async()
 
     def join_conference(self, event):
-        self.master.loop.create_task(self._join_selected_conference())
-
-    async def _join_selected_conference(self):
         selected_index = self.conference_list.curselection()
         if selected_index:
-            conference_name = self.conference_list.get(selected_index)
-            conferences = await self.client.get_conferences()
-            conference = next(conf for conf in conferences if conf.name == conference_name)
-            await self.client.join_conference(conference.id, self.client.username)
-            self.master.switch_frame(ConferenceFrame)
+            self.master.run_async(self._join_selected_conference(self.conference_list.get(selected_index)))
+
+    async def _join_selected_conference(self, conference_name):
+        conferences = await self.client.get_conferences()
+        conference = next(conf for conf in conferences if conf.name == conference_name)
+        await self.client.join_conference(conference.id, self.client.username)
+        self.master.post_ui(self.master.switch_frame, ConferenceFrame)
 
     async def refresh_conferences_async(self):
         conferences = await self.client.get_conferences()
+        self.master.post_ui(self.show_conferences, conferences)
+
+    def show_conferences(self, conferences):
         self.conference_list.delete(0, tk.END)
         for conference in conferences:
             self.conference_list.insert(tk.END, conference.name)
 
     def refresh_conferences(self):
-        self.master.loop.create_task(self.refresh_conferences_async())
+        self.master.run_async(self.refresh_conferences_async())
 
 
 class CreateConferenceDialog(tk.Toplevel):
@@ -265,8 +278,9 @@ class ConferenceFrame(ttk.Frame):
         self.is_sending_audio = False
         self.is_sending_video = False
         self.is_sharing_screen = False
-        self.frame_interval = 1/20  # 30 FPS
-        self.video_quality = 60
+        # 自适应码率：根据发送队列、连接积压和服务器的目标码率调整质量、分辨率和帧率
+        self.video_abr = BitrateController(VIDEO_ABR_PROFILE)
+        self.screen_abr = BitrateController(SCREEN_ABR_PROFILE)
         self.is_creator = self.conference.creator_id == self.client.user_id  # 使用 user_id 而不是 sio.sid
         print(f"Creator check: conference creator_id={self.conference.creator_id}, client user_id={self.client.user_id}, is_creator={self.is_creator}")  # 添加更详细的调试信息
         # 创建队列
@@ -274,11 +288,24 @@ class ConferenceFrame(ttk.Frame):
         self.screen_queue = asyncio.Queue(maxsize=2)
         self.audio_queue = asyncio.Queue(maxsize=5)
 
-        self.video_manager = VideoGridManager(self)
+        # 布局变化时自动更新视频订阅，服务器只转发正在显示的视频
+        self.video_manager = VideoGridManager(self, on_layout_change=self.on_video_layout_changed)
+        # 收到的视频先放入每个参与者的最新帧槽位，每个显示帧只解码最新的一帧，
+        # 在解码线程中缩放到显示尺寸，界面线程只负责显示
+        self.video_decoder = VideoDecoder(self.on_video_decoded)
+        # {user_id: 停止时最后一帧的序号}，UDP上迟于停止通知到达的帧不再显示，序号更大的帧表示重新开启
+        self.stopped_videos = {}
+        self._render_tick_id = self.after(UI_FRAME_INTERVAL_MS, self.render_tick)
+        self._map_bindings = [self.master.bind('<Map>', self.on_window_mapped, add='+'),
+                              self.master.bind('<Unmap>', self.on_window_unmapped, add='+')]
 
          # 音频处理相关的属性
         self.audio_buffer = []
         self.is_sending_audio = False
+        self.vad = VoiceActivityDetector()
+        # 收到的音频由独立线程经抖动缓冲区播放，不阻塞事件循环
+        self.audio_player = AudioPlayer(streamout)
+        self.audio_player.start()
         # self.audio_chunk_size = 1024
         # self.audio_queue = asyncio.Queue(maxsize=10)
 
@@ -386,76 +413,89 @@ class ConferenceFrame(ttk.Frame):
             close_button.grid(row=0, column=1, sticky="ew", padx=5)
     def setup_event_handlers(self):
         """设置事件处理"""
-        self.client.sio.on('audio', self.on_audio_received)
-        self.client.video_sio.on('video', self.on_video_received)
-        self.client.screen_sio.on('screen_share', self.on_screen_share_received)
+        self.client.on_media('audio', self.on_audio_received)
+        self.client.on_media('video', self.on_video_received)
+        self.client.on_media('screen_share', self.on_screen_share_received)
         self.client.sio.on('participant_joined', self.on_participant_joined)
         self.client.sio.on('participant_left', self.on_participant_left)
         self.client.sio.on('message_received', self.on_message_received)
         self.client.video_sio.on('video_stopped', self.on_video_stopped)
         self.client.screen_sio.on('screen_share_stopped', self.on_screen_share_stopped)
         self.client.sio.on('conference_closed', self.on_conference_closed)
+        self.client.sio.on('active_speakers', self.on_active_speakers)
     def start_processing_tasks(self):
         """启动异步处理任务"""
-        self.master.loop.create_task(self.process_video_queue())
-        self.master.loop.create_task(self.process_screen_queue())
-        self.master.loop.create_task(self.process_audio_queue())
+        self.master.run_async(self.process_video_queue())
+        self.master.run_async(self.process_screen_queue())
+        self.master.run_async(self.process_audio_queue())
 
+    # 以下网络事件处理在网络线程中执行，只更新数据并向Tk线程提交界面更新，不直接操作控件
     async def on_audio_received(self, data):
         """处理接收到的音频"""
         try:
-            
-            if data['conference_id'] != self.conference.id:
-                print("Received screen share from different conference")
+            data = self.client.unpack_media(data)
+            if data is None:
                 return
-            if 'data' in data and 'user_id' in data:
-                user_id = data['user_id']
+            if 'data' in data:
                 # 检查是否是混合音频
                 if data.get('mixed', False):
-                    # 直接播放混合后的音频
-                    streamout.write(data['data'])
-                    print(f"Received mixed audio from {user_id}")
-                else:
-                    # 如果不是混合音频，跳过自己发送的音频
-                    if user_id == self.client.user_id:
-                        streamout.write(data['data'])
-                        print(f"Received audio from {user_id}")
+                    # 解码后放入播放缓冲区
+                    self.audio_player.push(self.client.decode_audio(data), data.get('seq'))
+                elif data.get('user_id') == self.client.user_id:
+                    # 如果不是混合音频，只播放自己发送的音频
+                    self.audio_player.push(self.client.decode_audio(data), data.get('seq'))
         except Exception as e:
             print(f"Error playing received audio: {e}")
 
     async def on_video_received(self, data):
         """处理接收到的视频"""
         try:
-            
-            if data['conference_id'] != self.conference.id:
-                print("Received screen share from different conference")
+            data = self.client.unpack_media(data)
+            if data is None:
                 return
-            print("Received video")
-            if 'data' in data and 'user_id' in data:
+            if 'data' in data and data['user_id']:
                 user_id = data['user_id']
-                print(f"Received video from user {user_id}")
 
                 # 使用user_id进行比较而不是socket ID
                 if user_id == self.client.user_id:
                     print("Skipping own video")
                     return
+                if user_id in self.stopped_videos:
+                    stopped_seq = self.stopped_videos[user_id]
+                    if stopped_seq is None or data['seq'] <= stopped_seq:
+                        return
+                    del self.stopped_videos[user_id]
 
-                frame = decompress_image(data['data'])
-                self.video_manager.update_video(user_id, frame)
+                self.video_decoder.submit(user_id, data['data'], *self.video_manager.render_params(user_id))
         except Exception as e:
             print(f"Error displaying video: {e}")
 
+    def render_tick(self):
+        """每个显示帧把各参与者最新收到的视频帧交给解码线程"""
+        self.video_decoder.tick()
+        self._render_tick_id = self.after(UI_FRAME_INTERVAL_MS, self.render_tick)
+
+    def on_video_decoded(self, participant_id, image):
+        """解码线程完成一帧，同一参与者在一个显示帧内只显示最新的一帧"""
+        self.master.post_ui(self.show_video, participant_id, image, key=('video', participant_id))
+
+    def show_video(self, participant_id, image):
+        # 摄像头已经关闭时忽略关闭前提交的本地预览，参与者已经离开或关闭视频时忽略迟到的帧
+        if participant_id == 'local':
+            if not self.is_sending_video:
+                return
+        elif participant_id not in self.conference.participants or participant_id in self.stopped_videos:
+            return
+        self.video_manager.update_video(participant_id, image)
+
     async def on_screen_share_received(self, data):
         """处理接收到的屏幕共享"""
         try:
-            print("Received screen share")
-            
-            if data['conference_id'] != self.conference.id:
-                print("Received screen share from different conference")
+            data = self.client.unpack_media(data)
+            if data is None:
                 return
-            if 'data' in data and 'user_id' in data:
+            if 'data' in data and data['user_id']:
                 user_id = data['user_id']
-                print(f"Received screen share from user {user_id}")
                 
                 # 使用user_id进行比较
                 if user_id == self.client.user_id:
@@ -463,55 +503,106 @@ class ConferenceFrame(ttk.Frame):
                     return
     
                 screen = decompress_image(data['data'])
-                if not self.video_manager.is_screen_sharing:
-                    self.video_manager.start_screen_share(user_id)
-                self.video_manager.update_screen_share(screen)
+                self.master.post_ui(self.show_screen_share, user_id, screen, key='screen_share')
         except Exception as e:
             print(f"Error displaying screen share: {e}")
 
+    def show_screen_share(self, user_id, screen):
+        if not self.video_manager.is_screen_sharing:
+            self.video_manager.start_screen_share(user_id)
+        self.video_manager.update_screen_share(screen)
+
+    async def on_active_speakers(self, data):
+        """处理活跃发言者变化，优先显示发言者的视频"""
+        try:
+            if data['conference_id'] != self.conference.id:
+                return
+            speakers = ['local' if user_id == self.client.user_id else user_id
+                        for user_id in data['speakers']]
+            self.master.post_ui(self.video_manager.set_active_speakers, speakers, key='active_speakers')
+        except Exception as e:
+            print(f"Error handling active speakers: {e}")
+
     def on_participant_joined(self, data):
         """处理参与者加入事件"""
         if data['conference_id'] == self.conference.id:
             print(f"New participant joined: {data['client_name']}")
-            self.conference.participants[data['user_id']] = data['client_name']
-            self.update_participant_list()
+            self.master.post_ui(self.add_participant, data['user_id'], data['client_name'], data.get('stream_id'))
+            self.master.post_ui(self.update_participant_list, key='participants')
+            self.master.post_ui(self.update_video_subscriptions, key='video_subscriptions')
+
+    def add_participant(self, user_id, client_name, stream_id):
+        """在Tk线程修改参与者信息：复制后整体替换，网络线程读取时不会遇到正在修改的字典"""
+        self.conference.participants = {**self.conference.participants, user_id: client_name}
+        self.conference.stream_ids = {**self.conference.stream_ids, user_id: stream_id}
+
+    def remove_participant(self, user_id):
+        self.conference.participants = {uid: name for uid, name in self.conference.participants.items()
+                                        if uid != user_id}
+
+    def on_video_layout_changed(self, visible_tiles, discover_size):
+        self.update_video_subscriptions()
+
+    def update_video_subscriptions(self):
+        """订阅正在显示的视频（按各自的窗口大小），网格可见时还订阅尚未出现视频框的参与者"""
+        subscriptions = {}
+        for user_id in list(self.conference.participants):
+            if user_id == self.client.user_id:
+                continue
+            if user_id in self.video_manager.visible_tiles:
+                subscriptions[user_id] = self.video_manager.visible_tiles[user_id]
+            elif self.video_manager.discover_size and user_id not in self.video_manager.video_frames:
+                subscriptions[user_id] = self.video_manager.discover_size
+        self.master.run_async(self.client.subscribe_video(subscriptions))
+
+    def on_window_mapped(self, event):
+        if event.widget is self.master:
+            self.video_manager.set_hidden(False)
+
+    def on_window_unmapped(self, event):
+        if event.widget is self.master:
+            self.video_manager.set_hidden(True)
 
     def on_participant_left(self, data):
         """处理参与者离开事件"""
         if data['conference_id'] == self.conference.id:
             print(f"Participant left: {data['client_name']}")
-            if data['user_id'] in self.conference.participants:
-                del self.conference.participants[data['user_id']]
-            self.video_manager.remove_video(data['user_id'])
-            self.update_participant_list()
+            self.master.post_ui(self.remove_participant, data['user_id'])
+            self.stopped_videos.pop(data['user_id'], None)
+            self.video_decoder.forget(data['user_id'])
+            self.master.post_ui(self.video_manager.remove_video, data['user_id'])
+            self.master.post_ui(self.update_participant_list, key='participants')
 
     def close_conference_clicked(self):
         """处理关闭会议按钮点击"""
-        self.master.loop.create_task(self.close_conference())
+        if self.is_creator:
+            self.master.run_async(self.close_conference())
 
     async def close_conference(self):
         """关闭会议"""
-        if self.is_creator:
-            await self.client.close_conference()
-            self.cleanup()
-            self.master.switch_frame(ConferenceListFrame)
+        await self.client.close_conference()
+        self.master.post_ui(self.cleanup)
+        self.master.post_ui(self.master.switch_frame, ConferenceListFrame)
 
 
     def on_message_received(self, data):
         """处理接收到的消息"""
         sender = data['sender']
         message = data['message']
-        self.insert_message(f"{sender}: {message}")
+        self.master.post_ui(self.insert_message, f"{sender}: {message}")
 
     async def on_conference_closed(self, data):
             """处理会议被关闭的事件"""
             if self.conference and data['conference_id'] == self.conference.id:
-                # 停止所有媒体流
-                self.cleanup()
-                # 切换回会议列表界面
-                self.master.switch_frame(ConferenceListFrame)
-                # 显示提示消息
-                tk.messagebox.showinfo("会议已关闭", "会议已被创建者关闭")
+                self.master.post_ui(self.conference_closed)
+
+    def conference_closed(self):
+        # 停止所有媒体流
+        self.cleanup()
+        # 切换回会议列表界面
+        self.master.switch_frame(ConferenceListFrame)
+        # 显示提示消息
+        tk.messagebox.showinfo("会议已关闭", "会议已被创建者关闭")
     # UI Updates
     def update_participant_list(self):
         """更新参与者列表"""
@@ -532,19 +623,19 @@ class ConferenceFrame(ttk.Frame):
         """发送消息"""
         message = self.chat_input.get()
         if message:
-            self.master.loop.create_task(self._send_message_async(message))
+            self.master.run_async(self._send_message_async(message))
 
     async def _send_message_async(self, message):
         """异步发送消息"""
         await self.client.send_message(message)
-        self.chat_input.delete(0, tk.END)
+        self.master.post_ui(self.chat_input.delete, 0, tk.END)
 
     # Control Bar Callbacks
     def handle_mic_toggle(self, should_enable):
         try:
             if should_enable:
                 print("Starting audio...")  # 添加调试信息
-                self.master.loop.create_task(self.start_audio())
+                self.master.run_async(self.start_audio())
                 self.is_sending_audio = True
             else:
                 print("Stopping audio...")  # 添加调试信息
@@ -559,7 +650,7 @@ class ConferenceFrame(ttk.Frame):
         """处理摄像头开关"""
         try:
             if should_enable:
-                self.master.loop.create_task(self.start_video())
+                self.master.run_async(self.start_video())
                 self.is_sending_video = True
                 self.video_manager.set_video_active('local', True)
             else:
@@ -591,7 +682,7 @@ class ConferenceFrame(ttk.Frame):
                 success = self.video_manager.start_screen_share('local')
                 if success:
                     self.is_sharing_screen = True
-                    self.master.loop.create_task(self.start_screen_share())
+                    self.master.run_async(self.start_screen_share())
                 return success
             else:
                 # 停止屏幕共享
@@ -609,16 +700,24 @@ class ConferenceFrame(ttk.Frame):
         """开始音频流"""
         print("Starting audio stream...")
         self.is_sending_audio = True
+        # 采集在PyAudio回调线程中进行，这里只负责非阻塞地取出数据
+        start_voice_capture()
         
         while self.is_sending_audio:
             try:
-                # 捕获音频数据
+                # 取出所有已采集的音频块
                 audio_data = capture_voice()
-                if audio_data and not self.audio_queue.full():
-                    # 将音频数据放入队列
-                    await self.audio_queue.put(audio_data)
-                    print("Put audio data into queue")
-                await asyncio.sleep(0.05)  # 降低CPU使用率
+                if audio_data is None:
+                    await asyncio.sleep(CHUNK / RATE / 2)
+                    continue
+                # 静音检测：静音帧不发送，只定期发送保活标记
+                state = self.vad.process(audio_data)
+                if state != VoiceActivityDetector.SILENCE and not self.audio_queue.full():
+                    # 将音频数据（或保活标记）放入队列
+                    if state == VoiceActivityDetector.SPEECH:
+                        await self.audio_queue.put(audio_data)
+                    else:
+                        await self.audio_queue.put({'dtx': True})
             except Exception as e:
                 print(f"Error capturing audio: {e}")
                 self.is_sending_audio = False
@@ -633,19 +732,27 @@ class ConferenceFrame(ttk.Frame):
         while self.is_sending_video:
             try:
                 current_time = time.time()
-                if current_time - last_frame_time < self.frame_interval:
+                if current_time - last_frame_time < self.video_abr.frame_interval:
                     await asyncio.sleep(0.001)
                     continue
                     
                 frame = capture_camera()
-                if frame and not self.video_queue.full():
-                    # 压缩质量降低以减少数据量
-                    compressed_frame = compress_image(frame, quality=self.video_quality)
-                    await self.video_queue.put({
-                        'data': compressed_frame,
-                        'participant_id': self.client.sio.sid
-                    })
-                    self.video_manager.update_video('local', frame)
+                if frame:
+                    self.update_abr_target()
+                    self.video_abr.update(self.video_queue.qsize() / self.video_queue.maxsize)
+                    if self.video_queue.full():
+                        self.video_abr.on_frame_dropped()
+                    else:
+                        # 联播：同一帧编码为多个尺寸，服务器按每个接收者的窗口大小和带宽选择一层
+                        image = self.video_abr.prepare(frame)
+                        layers = (compress_simulcast(image, self.video_abr.quality) if SIMULCAST_ENABLED
+                                  else [compress_image(image, quality=self.video_abr.quality)])
+                        self.video_abr.on_frame_encoded(sum(len(layer) for layer in layers))
+                        await self.video_queue.put({
+                            'layers': layers,
+                            'participant_id': self.client.sio.sid
+                        })
+                    self.video_decoder.submit('local', frame, *self.video_manager.render_params('local'))
                     last_frame_time = current_time
                     
                 await asyncio.sleep(0.001)
@@ -659,41 +766,68 @@ class ConferenceFrame(ttk.Frame):
         while self.is_sharing_screen:
             try:
                 screen = capture_screen()
-                if screen and not self.screen_queue.full():
-                    compressed_screen = compress_image(screen, quality=70)  # 降低一点质量以减少数据量
-                    screen_data = {
-                        'data': compressed_screen,
-                        'participant_id': self.client.sio.sid
-                    }
-                    await self.screen_queue.put(screen_data)
+                if screen:
+                    self.update_abr_target()
+                    self.screen_abr.update(self.screen_queue.qsize() / self.screen_queue.maxsize)
+                    if self.screen_queue.full():
+                        self.screen_abr.on_frame_dropped()
+                    else:
+                        compressed_screen = compress_image(self.screen_abr.prepare(screen),
+                                                           quality=self.screen_abr.quality)
+                        self.screen_abr.on_frame_encoded(len(compressed_screen))
+                        screen_data = {
+                            'data': compressed_screen,
+                            'participant_id': self.client.sio.sid
+                        }
+                        await self.screen_queue.put(screen_data)
                     # 更新本地预览
-                    self.video_manager.update_screen_share(screen)
-                await asyncio.sleep(self.frame_interval)
+                    self.master.post_ui(self.show_local_screen, screen, key='screen_share')
+                await asyncio.sleep(self.screen_abr.frame_interval)
             except Exception as e:
                 print(f"Error in screen sharing: {e}")
                 break
 
 
+    def show_local_screen(self, screen):
+        if self.is_sharing_screen:
+            self.video_manager.update_screen_share(screen)
+
+    @staticmethod
+    def clear_queue(queue):
+        """清空发送队列（asyncio.Queue不是线程安全的，需要在网络线程中调用）"""
+        while not queue.empty():
+            try:
+                queue.get_nowait()
+                queue.task_done()
+            except asyncio.QueueEmpty:
+                break
+
+    def update_abr_target(self):
+        """服务器下发的目标码率由摄像头和屏幕共享平分"""
+        target = self.client.target_bitrate
+        sources = [abr for abr, active in ((self.video_abr, self.is_sending_video),
+                                           (self.screen_abr, self.is_sharing_screen)) if active]
+        for abr in sources:
+            abr.set_target_bitrate(target / len(sources) if target else None)
+
     def stop_audio(self):
         """停止音频流"""
         print("Stopping audio stream...")
         self.is_sending_audio = False
+        stop_voice_capture()
+        print(f"Audio capture stats: {capture_buffer.stats()}")
         # 清空音频队列
-        while not self.audio_queue.empty():
-            try:
-                self.audio_queue.get_nowait()
-                self.audio_queue.task_done()
-            except asyncio.QueueEmpty:
-                break
+        self.master.async_thread.call_soon(self.clear_queue, self.audio_queue)
 
     def stop_video(self):
         """停止视频流"""
         print("正在停止视频流...")
         self.is_sending_video = False
+        print(f"Video ABR stats: {self.video_abr.stats()}")
 
         try:
             # 通知其他用户
-            self.master.loop.create_task(self.client.notify_video_stopped())
+            self.master.run_async(self.client.notify_video_stopped())
 
             # 确保视频被正确停止并清理
             if hasattr(self, 'video_manager'):
@@ -702,12 +836,7 @@ class ConferenceFrame(ttk.Frame):
                 self.video_manager.remove_video('local')
 
             # 清空视频队列
-            while not self.video_queue.empty():
-                try:
-                    self.video_queue.get_nowait()
-                    self.video_queue.task_done()
-                except asyncio.QueueEmpty:
-                    break
+            self.master.async_thread.call_soon(self.clear_queue, self.video_queue)
         except Exception as e:
             print(f"停止视频时出错: {e}")
 
@@ -715,26 +844,19 @@ class ConferenceFrame(ttk.Frame):
         """停止屏幕共享"""
         print("正在停止屏幕共享...")
         self.is_sharing_screen = False
+        print(f"Screen ABR stats: {self.screen_abr.stats()}")
 
         try:
             # 通知其他用户
-            self.master.loop.create_task(self.client.notify_screen_share_stopped())
+            self.master.run_async(self.client.notify_screen_share_stopped())
 
             # 确保屏幕共享被正确停止并清理
             if hasattr(self, 'video_manager'):
                 # 停止屏幕共享并更新UI
                 success = self.video_manager.stop_screen_share('local')
 
-                # 强制更新界面
-                self.video_manager.container.update_idletasks()
-
             # 清空屏幕共享队列
-            while not self.screen_queue.empty():
-                try:
-                    self.screen_queue.get_nowait()
-                    self.screen_queue.task_done()
-                except asyncio.QueueEmpty:
-                    break
+            self.master.async_thread.call_soon(self.clear_queue, self.screen_queue)
 
             return success
         except Exception as e:
@@ -747,8 +869,10 @@ class ConferenceFrame(ttk.Frame):
                 user_id = data['user_id']
                 if user_id != self.client.user_id:  # 不处理自己的停止事件
                     print(f"User {user_id} stopped video")
-                    self.video_manager.set_video_active(user_id, False)
-                    self.video_manager.remove_video(user_id)
+                    self.stopped_videos[user_id] = data.get('seq')
+                    self.video_decoder.forget(user_id)
+                    self.master.post_ui(self.video_manager.set_video_active, user_id, False)
+                    self.master.post_ui(self.video_manager.remove_video, user_id)
         except Exception as e:
             print(f"处理视频停止事件时出错: {e}")
 
@@ -759,10 +883,13 @@ class ConferenceFrame(ttk.Frame):
                 user_id = data['user_id']
                 if user_id != self.client.user_id:  # 不处理自己的停止事件
                     print(f"User {user_id} stopped screen sharing")
-                    if self.video_manager.screen_sharer_id == user_id:
-                        self.video_manager.stop_screen_share(user_id)
+                    self.master.post_ui(self.remote_screen_share_stopped, user_id)
         except Exception as e:
             print(f"处理屏幕共享停止事件时出错: {e}")
+    def remote_screen_share_stopped(self, user_id):
+        if self.video_manager.screen_sharer_id == user_id:
+            self.video_manager.stop_screen_share(user_id)
+
     # Queue Processing
     async def process_video_queue(self):
         """处理视频队列"""
@@ -770,6 +897,7 @@ class ConferenceFrame(ttk.Frame):
             try:
                 video_data = await self.video_queue.get()
                 if video_data is not None:
+                    self.video_abr.on_backlog(self.client.transport_backlog('video'))
                     await self.client.send_video(video_data)
                 await asyncio.sleep(0.01)
             except Exception as e:
@@ -784,6 +912,7 @@ class ConferenceFrame(ttk.Frame):
                 screen_data = await self.screen_queue.get()
                 if screen_data is not None:
                     print(f"Sending screen share, queue size: {self.screen_queue.qsize()}")
+                    self.screen_abr.on_backlog(self.client.transport_backlog('screen_share'))
                     await self.client.send_screen_share(screen_data)
                 await asyncio.sleep(0.001)
             except Exception as e:
@@ -809,13 +938,13 @@ class ConferenceFrame(ttk.Frame):
     # Conference Control
     def leave_conference_clicked(self):
         """处理离开会议按钮点击"""
-        self.master.loop.create_task(self.leave_conference())
+        self.cleanup()
+        self.master.run_async(self.leave_conference())
 
     async def leave_conference(self):
         """离开会议"""
-        self.cleanup()
         await self.client.leave_conference()
-        self.master.switch_frame(ConferenceListFrame)
+        self.master.post_ui(self.master.switch_frame, ConferenceListFrame)
 
     def cleanup(self):
         """清理所有资源"""
@@ -835,14 +964,20 @@ class ConferenceFrame(ttk.Frame):
                 for participant_id in list(self.video_manager.video_frames.keys()):
                     self.video_manager.remove_video(participant_id)
 
+            self.master.unbind('<Map>', self._map_bindings[0])
+            self.master.unbind('<Unmap>', self._map_bindings[1])
+
+            self.after_cancel(self._render_tick_id)
+            self.video_decoder.close()
+            print(f"Video decode stats: {self.video_decoder.stats()}")
+
+            # 停止音频播放
+            self.audio_player.stop()
+            print(f"Audio playback stats: {self.audio_player.stats()}")
+
             # 清空所有队列
             for queue in [self.video_queue, self.screen_queue, self.audio_queue]:
-                while not queue.empty():
-                    try:
-                        queue.get_nowait()
-                        queue.task_done()
-                    except asyncio.QueueEmpty:
-                        pass
+                self.master.async_thread.call_soon(self.clear_queue, queue)
         except Exception as e:
             print(f"清理资源时出错: {e}")
 if __name__ == "__main__":
@@ -853,9 +988,5 @@ if __name__ == "__main__":
     try:
         gui.mainloop()
     finally:
-        # 主循环结束后取消所有未完成任务
-        pending = asyncio.all_tasks(loop)
-        for task in pending:
-            task.cancel()
-        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
-        loop.close()
\ No newline at end of file
+        # 主循环结束后取消所有未完成任务并停止事件循环线程
+        gui.async_thread.stop()
\ No newline at end of file
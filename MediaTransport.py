@@ -0,0 +1,187 @@
+import asyncio
+import struct
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+from config import DGRAM_SIZE, UDP_FEC_GROUP, UDP_REASSEMBLY_TIMEOUT
+
+# UDP数据报头部：类型(B) 媒体类型(B) 流ID(H) 帧序号(I) 分片/校验组序号(H) 分片总数(H)
+# 负载是完整二进制媒体帧（见protocol.py）的一个分片
+PACKET_HEADER = struct.Struct('!BBHIHH')
+
+# 媒体类型字节的高4位为联播层，服务器转发分片时不需要重组就能按层过滤
+KIND_MASK = 0x0F
+LAYER_SHIFT = 4
+
+PACKET_DATA = 0  # 数据分片
+PACKET_FEC = 1  # XOR校验分片，每UDP_FEC_GROUP个数据分片一个
+PACKET_HELLO = 2  # 客户端登记自己的UDP地址，负载为会话令牌；服务器原样返回作为确认
+
+# 每个分片的最大负载：MTU - IP/UDP头部(28) - 本头部 - 校验恢复所需的2字节长度
+MAX_FRAGMENT = DGRAM_SIZE - 28 - PACKET_HEADER.size - 2
+
+
+class PacketHeader:
+    __slots__ = ('ptype', 'kind', 'layer', 'stream_id', 'frame_seq', 'index', 'count')
+
+    def __init__(self, packet):
+        self.ptype, kind, self.stream_id, self.frame_seq, self.index, self.count = \
+            PACKET_HEADER.unpack_from(packet)
+        self.kind = kind & KIND_MASK
+        self.layer = kind >> LAYER_SHIFT
+
+
+def pack_hello(stream_id: int, token: str) -> bytes:
+    return PACKET_HEADER.pack(PACKET_HELLO, 0, stream_id, 0, 0, 0) + token.encode()
+
+
+def _xor_parity(fragments) -> bytes:
+    """计算一组分片的XOR校验，每个分片前加2字节长度，按最长分片补零对齐"""
+    width = max(len(fragment) for fragment in fragments) + 2
+    matrix = np.zeros((len(fragments), width), dtype=np.uint8)
+    for row, fragment in zip(matrix, fragments):
+        row[:2] = np.frombuffer(struct.pack('!H', len(fragment)), dtype=np.uint8)
+        row[2:2 + len(fragment)] = np.frombuffer(fragment, dtype=np.uint8)
+    return np.bitwise_xor.reduce(matrix, axis=0).tobytes()
+
+
+class Packetizer:
+    """把媒体帧切分为不超过MTU的UDP数据报，并可附加XOR前向纠错分片"""
+    def __init__(self, stream_id: int, fec_group: int = UDP_FEC_GROUP):
+        self.stream_id = stream_id
+        self.fec_group = fec_group
+        self.frame_seq = 0
+
+    def packetize(self, kind: int, frame: bytes, layer: int = 0) -> List[bytes]:
+        self.frame_seq = (self.frame_seq + 1) & 0xFFFFFFFF
+        kind |= layer << LAYER_SHIFT
+        view = memoryview(frame)
+        fragments = [view[i:i + MAX_FRAGMENT] for i in range(0, len(frame), MAX_FRAGMENT)] or [view[:0]]
+        count = len(fragments)
+        packets = [PACKET_HEADER.pack(PACKET_DATA, kind, self.stream_id, self.frame_seq, index, count) + fragment
+                   for index, fragment in enumerate(fragments)]
+
+        if self.fec_group > 1:
+            # 每组丢失任意一个分片都可以由校验分片恢复；只有一个分片的组（包括单分片帧）的校验就是它的副本
+            for group, start in enumerate(range(0, count, self.fec_group)):
+                members = fragments[start:start + self.fec_group]
+                packets.append(PACKET_HEADER.pack(PACKET_FEC, kind, self.stream_id, self.frame_seq, group, count)
+                               + _xor_parity(members))
+        return packets
+
+
+class _PendingFrame:
+    __slots__ = ('kind', 'count', 'fragments', 'parity', 'created')
+
+    def __init__(self, kind, count, now):
+        self.kind = kind
+        self.count = count
+        self.fragments: Dict[int, bytes] = {}
+        self.parity: Dict[int, bytes] = {}
+        self.created = now
+
+
+class Reassembler:
+    """把收到的UDP分片重组为媒体帧，必要时用XOR校验恢复单个丢失的分片"""
+    def __init__(self, fec_group: int = UDP_FEC_GROUP, timeout: float = UDP_REASSEMBLY_TIMEOUT):
+        self.fec_group = fec_group
+        self.timeout = timeout
+        self.pending: Dict[Tuple[int, int], _PendingFrame] = {}
+        self._done = OrderedDict()  # 最近完成的帧，用于忽略之后到达的多余分片
+        self._last_purge = 0.0
+
+        # 统计信息
+        self.completed_frames = 0
+        self.recovered_fragments = 0
+        self.expired_frames = 0
+
+    def add(self, packet: bytes, header: Optional[PacketHeader] = None,
+            now: Optional[float] = None) -> Optional[Tuple[int, bytes]]:
+        """处理一个数据报，帧完整时返回 (媒体类型, 媒体帧)"""
+        now = time.monotonic() if now is None else now
+        header = header or PacketHeader(packet)
+        key = (header.stream_id, header.frame_seq)
+        if key in self._done:
+            return None
+        self._purge(now)
+
+        payload = packet[PACKET_HEADER.size:]
+        if header.ptype == PACKET_DATA and header.count == 1:
+            # 单分片帧（例如音频）无需缓存
+            self._finish(key)
+            return header.kind, payload
+
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = _PendingFrame(header.kind, header.count, now)
+        if header.ptype == PACKET_DATA:
+            pending.fragments[header.index] = payload
+            group = header.index // self.fec_group if self.fec_group > 1 else None
+        else:
+            pending.parity[header.index] = payload
+            group = header.index
+        if group is not None:
+            self._recover(pending, group)
+
+        if len(pending.fragments) == pending.count:
+            del self.pending[key]
+            self._finish(key)
+            return pending.kind, b''.join(pending.fragments[i] for i in range(pending.count))
+        return None
+
+    def _recover(self, pending: _PendingFrame, group: int):
+        """组内只丢失一个分片且收到了校验分片时，恢复该分片"""
+        parity = pending.parity.get(group)
+        if parity is None:
+            return
+        indices = range(group * self.fec_group, min((group + 1) * self.fec_group, pending.count))
+        missing = [index for index in indices if index not in pending.fragments]
+        if len(missing) != 1:
+            return
+        present = [pending.fragments[index] for index in indices if index in pending.fragments]
+        # 校验按组内最长分片对齐，其余分片的XOR不会比它长
+        restored = np.frombuffer(parity, dtype=np.uint8).copy()
+        if present:
+            partial = np.frombuffer(_xor_parity(present), dtype=np.uint8)
+            if len(partial) > len(restored):
+                return
+            restored[:len(partial)] ^= partial
+        length = struct.unpack('!H', restored[:2].tobytes())[0]
+        pending.fragments[missing[0]] = restored[2:2 + length].tobytes()
+        self.recovered_fragments += 1
+
+    def _finish(self, key):
+        self.completed_frames += 1
+        self._done[key] = True
+        if len(self._done) > 256:
+            self._done.popitem(last=False)
+
+    def _purge(self, now):
+        """丢弃超时仍未完整的帧"""
+        if now - self._last_purge < self.timeout / 2:
+            return
+        self._last_purge = now
+        expired = [key for key, pending in self.pending.items() if now - pending.created > self.timeout]
+        for key in expired:
+            del self.pending[key]
+            self.expired_frames += 1
+
+
+class MediaDatagramProtocol(asyncio.DatagramProtocol):
+    """把收到的数据报交给回调处理"""
+    def __init__(self, on_packet: Callable[[bytes, tuple], None]):
+        self.on_packet = on_packet
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            self.on_packet(data, addr)
+        except Exception as e:
+            print(f"Error handling media datagram: {e}")
+
+    def error_received(self, exc):
+        print(f"Media UDP error: {exc}")
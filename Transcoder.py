@@ -0,0 +1,102 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+from PIL import Image
+from protocol import pack_media_frame, unpack_media_header, media_payload
+from config import TRANSCODE_WIDTHS, TRANSCODE_QUALITY, TRANSCODE_WORKERS
+
+
+def transcode_jpeg(payload: bytes, widths, quality) -> Tuple[int, Dict[int, bytes]]:
+    """在工作进程中执行：解码一次JPEG并生成各档宽度的JPEG，返回 (原图宽度, {宽度: JPEG})
+
+    只生成比原图窄的档位。draft让解码器直接按1/2、1/4、1/8缩小DCT，解码量随最大档位下降；
+    较小的档位依次从上一档缩小。
+    """
+    image = Image.open(BytesIO(payload))
+    source_width, source_height = image.size
+    targets = sorted((width for width in widths if width < source_width), reverse=True)
+    if not targets:
+        return source_width, {}
+    image.draft('RGB', (targets[0], max(1, source_height * targets[0] // source_width)))
+    image = image.convert('RGB')
+
+    variants = {}
+    for width in targets:
+        size = (width, max(1, round(source_height * width / source_width)))
+        if image.size != size:
+            image = image.resize(size, Image.BILINEAR)
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=quality)
+        variants[width] = buffer.getvalue()
+    return source_width, variants
+
+
+class Transcoder:
+    """服务器端视频转码，供不支持联播的发布者使用
+
+    把发布者的帧缩小为几档宽度，发给窗口较小或带宽不足的订阅者。每帧只解码一次，在进程池中
+    生成所有需要的档位，同一档位的订阅者共用同一份数据；每个发布者缓存最新一帧的结果，新订阅
+    的窗口可以立即显示。上一帧还在转码时新帧直接跳过，转码订阅者的帧率随之下降而不会积压。
+    """
+    def __init__(self, widths=TRANSCODE_WIDTHS, quality=TRANSCODE_QUALITY, workers=TRANSCODE_WORKERS):
+        self.widths = tuple(sorted(widths, reverse=True))
+        self.quality = quality
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._pending = set()  # 正在转码的发布者
+        self._latest: Dict[str, Dict[int, bytes]] = {}  # {publisher_id: {width: 媒体帧}}，最新一帧的各档结果
+        self.source_widths: Dict[str, int] = {}  # {publisher_id: 原图宽度}
+
+        # 统计信息
+        self.transcoded_frames = 0
+        self.skipped_frames = 0
+        self.failed_frames = 0
+
+    async def variants(self, publisher_id, frame, widths) -> Optional[Dict[int, bytes]]:
+        """把一个视频帧转码为指定的各档宽度，返回 {宽度: 媒体帧}（不含不小于原图的档位）
+
+        该发布者的上一帧还在转码时返回None。
+        """
+        if publisher_id in self._pending:
+            self.skipped_frames += 1
+            return None
+        header = unpack_media_header(frame)
+        self._pending.add(publisher_id)
+        try:
+            loop = asyncio.get_running_loop()
+            source_width, payloads = await loop.run_in_executor(
+                self._pool, transcode_jpeg, bytes(media_payload(frame)), tuple(widths), self.quality)
+        except Exception as e:
+            self.failed_frames += 1
+            print(f"Error transcoding video: {e}")
+            return None
+        finally:
+            self._pending.discard(publisher_id)
+
+        # 保留原来的头部（序号、时间戳、标志），只替换负载
+        variants = {width: pack_media_frame(header.kind, header.stream_id, header.seq, payload,
+                                            flags=header.flags, timestamp=header.timestamp)
+                    for width, payload in payloads.items()}
+        self.source_widths[publisher_id] = source_width
+        self._latest[publisher_id] = variants
+        self.transcoded_frames += 1
+        return variants
+
+    def latest(self, publisher_id, width) -> Optional[bytes]:
+        """发布者最新一帧在该档位的转码结果"""
+        return self._latest.get(publisher_id, {}).get(width)
+
+    def forget(self, publisher_id):
+        self._latest.pop(publisher_id, None)
+        self.source_widths.pop(publisher_id, None)
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+
+    def stats(self):
+        return {
+            'transcoded': self.transcoded_frames,
+            'skipped': self.skipped_frames,
+            'failed': self.failed_frames,
+            'publishers': len(self._latest),
+        }
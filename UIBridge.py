@@ -0,0 +1,114 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Coroutine, Optional
+
+
+class AsyncioThread:
+    """在独立线程中运行asyncio事件循环
+
+    网络收发不再依赖Tk定时轮询，Tk重绘耗时也不会拖慢音频。Tk线程通过submit提交协程，
+    不能直接调用loop.create_task（事件循环不是线程安全的）。
+    """
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop or asyncio.new_event_loop()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='asyncio', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro: Coroutine) -> Future:
+        """在事件循环线程中运行协程（可在任意线程调用），返回concurrent.futures.Future"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._report)
+        return future
+
+    def call_soon(self, callback: Callable, *args):
+        """在事件循环线程中调用普通函数"""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    @staticmethod
+    def _report(future: Future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Error in async task: {future.exception()!r}")
+
+    def stop(self, timeout: float = 2):
+        """取消所有未完成的任务，停止事件循环并等待线程退出"""
+        if not self._thread:
+            return
+
+        async def cancel_tasks():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(cancel_tasks(), self.loop).result(timeout)
+            except Exception as e:
+                print(f"Error cancelling async tasks: {e}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+        if not self.loop.is_running():
+            self.loop.close()
+
+
+class UIUpdateQueue:
+    """线程安全的界面更新队列，由Tk线程每个显示帧取出执行一次
+
+    网络线程只提交更新意图，不直接操作控件。带key的更新会合并：同一key只保留最新提交的
+    一个（例如同一参与者的视频帧），排到队尾；不带key的更新（参与者变化、聊天消息等）
+    按提交顺序全部执行。
+    """
+    def __init__(self):
+        self._updates = OrderedDict()  # {key: (callback, args)}
+        self._lock = threading.Lock()
+        self._seq = 0
+
+        # 统计信息
+        self.posted = 0
+        self.coalesced = 0  # 被同一key的新更新替换
+        self.executed = 0
+
+    def post(self, callback: Callable, *args, key=None):
+        with self._lock:
+            self.posted += 1
+            if key is None:
+                self._seq += 1
+                key = ('seq', self._seq)
+            elif key in self._updates:
+                self.coalesced += 1
+                del self._updates[key]
+            self._updates[key] = (callback, args)
+
+    def drain(self, stop: Optional[Callable[[], bool]] = None):
+        """执行当前排队的所有更新（在Tk线程调用），执行期间新提交的更新留到下一帧
+
+        stop返回True时停止执行剩余的更新（例如窗口已经销毁）。
+        """
+        with self._lock:
+            updates, self._updates = self._updates, OrderedDict()
+        for callback, args in updates.values():
+            if stop and stop():
+                break
+            try:
+                callback(*args)
+                self.executed += 1
+            except Exception as e:
+                print(f"Error updating UI: {e}")
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._updates)
+        return {'posted': self.posted, 'coalesced': self.coalesced, 'executed': self.executed,
+                'pending': pending}
@@ -0,0 +1,111 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Callable, Dict, Tuple
+from PIL import Image
+from config import VIDEO_DECODE_WORKERS
+
+
+def decode_to_size(data, size: Tuple[int, int], resample=Image.Resampling.LANCZOS) -> Image.Image:
+    """把JPEG（或已解码的图像）转换为恰好size大小的RGB图像
+
+    JPEG先用draft按1/2、1/4、1/8缩小DCT解码（结果不小于size），剩下的缩放量很小，
+    用resample指定的滤波器完成。
+    """
+    if isinstance(data, Image.Image):
+        image = data
+    else:
+        image = Image.open(BytesIO(data))
+        image.draft('RGB', size)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if image.size != size:
+        image = image.resize(size, resample)
+    return image
+
+
+class VideoDecoder:
+    """客户端视频解码线程池
+
+    收到的帧先放入每个参与者的最新帧槽位，新帧直接覆盖还没有解码的旧帧；界面每个显示帧调用
+    一次tick，把各槽位中最新的一帧交给线程池解码并缩放为视频框的显示尺寸，完成后交给
+    on_decoded(participant_id, image)，界面线程只需要显示。因此解码量不超过显示帧率，与发送方
+    帧率和网络抖动后一次到达的帧数无关，积压的旧帧不会带来额外延迟。PIL解码和缩放时释放GIL，
+    多个线程可以并行处理多路视频；每个参与者同时只有一帧在解码。forget之后，之前提交或
+    正在解码的帧都不会再交给on_decoded。
+    """
+    def __init__(self, on_decoded: Callable[[str, Image.Image], None], workers=VIDEO_DECODE_WORKERS):
+        self.on_decoded = on_decoded
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='video-decode')
+        self._lock = threading.Lock()
+        self._slots: Dict[str, tuple] = {}  # {participant_id: (data, size, resample, generation)}，等待解码的最新一帧
+        self._generations: Dict[str, int] = {}  # {participant_id: forget次数}，解码完成时代数已变的帧直接丢弃
+        self._busy = set()  # 正在解码的参与者
+        self._closed = False
+
+        # 统计信息
+        self.decoded_frames = 0
+        self.failed_frames = 0
+        self.skipped_frames: Dict[str, int] = {}  # {participant_id: 没有解码就被新帧覆盖的帧数}
+        self.decode_time = 0.0  # 每帧解码耗时的滑动平均（秒）
+
+    def submit(self, participant_id, data, size: Tuple[int, int], resample=Image.Resampling.LANCZOS):
+        """放入一帧（JPEG字节或PIL图像），覆盖该参与者尚未解码的帧，可在任意线程调用"""
+        with self._lock:
+            if self._closed:
+                return
+            if participant_id in self._slots:
+                self.skipped_frames[participant_id] = self.skipped_frames.get(participant_id, 0) + 1
+            self._slots[participant_id] = (data, size, resample, self._generations.get(participant_id, 0))
+
+    def tick(self):
+        """每个显示帧调用一次：解码每个空闲参与者槽位中最新的一帧"""
+        with self._lock:
+            if self._closed:
+                return
+            ready = [(participant_id, slot) for participant_id, slot in self._slots.items()
+                     if participant_id not in self._busy]
+            for participant_id, _ in ready:
+                del self._slots[participant_id]
+                self._busy.add(participant_id)
+        for participant_id, slot in ready:
+            self._pool.submit(self._decode, participant_id, *slot)
+
+    def _decode(self, participant_id, data, size, resample, generation):
+        started = time.monotonic()
+        try:
+            image = decode_to_size(data, size, resample)
+            self.decode_time += (time.monotonic() - started - self.decode_time) / 16
+            self.decoded_frames += 1
+            # 持有锁交出结果，forget返回后不会再有该参与者之前的帧交给on_decoded
+            with self._lock:
+                if not self._closed and self._generations.get(participant_id, 0) == generation:
+                    self.on_decoded(participant_id, image)
+        except Exception as e:
+            self.failed_frames += 1
+            print(f"Error decoding video from {participant_id}: {e}")
+        finally:
+            with self._lock:
+                self._busy.discard(participant_id)
+
+    def forget(self, participant_id):
+        """丢弃参与者尚未解码和正在解码的帧（例如对方已经关闭视频）"""
+        with self._lock:
+            self._slots.pop(participant_id, None)
+            self._generations[participant_id] = self._generations.get(participant_id, 0) + 1
+
+    def close(self):
+        """停止解码，丢弃尚未解码的帧"""
+        with self._lock:
+            self._closed = True
+            self._slots.clear()
+        self._pool.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'decoded': self.decoded_frames,
+            'skipped': dict(self.skipped_frames),
+            'failed': self.failed_frames,
+            'decode_ms': round(self.decode_time * 1000, 2),
+        }
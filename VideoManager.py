@@ -2,16 +2,38 @@ import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
 import math
+from config import VIDEO_GRID_MAX_TILES, VIDEO_RESAMPLE, VIDEO_SMALL_TILE_WIDTH, VIDEO_RESIZE_DEBOUNCE_MS
+
+RESAMPLE_FILTERS = {
+    'nearest': Image.Resampling.NEAREST,
+    'bilinear': Image.Resampling.BILINEAR,
+    'lanczos': Image.Resampling.LANCZOS,
+}
 
 class VideoGridManager:
-    def __init__(self, parent_frame):
-        """初始化视频网格管理器"""
+    def __init__(self, parent_frame, on_layout_change=None, max_tiles=VIDEO_GRID_MAX_TILES):
+        """初始化视频网格管理器
+
+        on_layout_change(visible_tiles, discover_size) 在显示的视频框变化时调用：visible_tiles为
+        {participant_id: (width, height)}；discover_size为尚未显示的参与者应订阅的尺寸，
+        网格不可见（屏幕共享或窗口最小化）时为None
+        """
         self.parent_frame = parent_frame
-        self.video_frames = {}  # {participant_id: {'frame': frame, 'label': label, 'active': bool}}
+        self.on_layout_change = on_layout_change
+        self.max_tiles = max_tiles
+        self.visible_tiles = {}
+        self.discover_size = None
+        self.hidden = False  # 窗口最小化
+        self.video_frames = {}  # {participant_id: {'frame': frame, 'label': label, 'active': bool, 'photo': PhotoImage}}
         self.screen_share_frame = None
         self.screen_share_label = None
+        self._screen_photo = None
+        self._black_photo = None  # 视频关闭时显示的黑色占位图，所有视频框共用
+        self._layout_id = None  # 已安排的布局更新
+        self._resize_id = None  # 窗口大小变化后延迟执行的布局更新
         self.is_screen_sharing = False
         self.screen_sharer_id = None
+        self.active_speakers = []  # 当前活跃发言者，布局时排在最前面
         
         # 设置默认的视频尺寸和容器尺寸
         self.default_video_width = 320
@@ -32,6 +54,12 @@ class VideoGridManager:
         # 创建视频网格容器
         self.video_grid = ttk.Frame(self.container)
         self.video_grid.grid(row=0, column=0, sticky='nsew')
+        # 视频图像的显示尺寸和缩放滤波器，只在布局或窗口大小变化时重新计算；
+        # 解码线程直接按各视频框的尺寸解码，每帧不再计算布局
+        self.image_size = (self.default_video_width, self.default_video_height)
+        self.tile_geometry = {}  # {participant_id: ((width, height), resample)}
+        self._shown_tiles = []  # 当前显示的视频框，按网格顺序
+        self.video_grid.bind('<Configure>', self._on_grid_resize, add='+')
         
         # 初始化屏幕共享组件
         self._init_screen_share_components()
@@ -69,38 +97,32 @@ class VideoGridManager:
         self.video_frames[participant_id] = {
             'frame': frame,
             'label': label,
-            'active': False
+            'active': False,
+            'photo': None
         }
         
         if initial_image:
             self.update_video(participant_id, initial_image)
         
-        self.update_layout()
-        
-    def remove_video(self, participant_id):
-        """移除视频框"""
-        if participant_id in self.video_frames:
-            try:
-                # 清除图像
-                label = self.video_frames[participant_id]['label']
-                label.configure(image='')
-                label.image = None
-
-                # 显示黑色背景
-                black_img = Image.new('RGB', (self.default_video_width, self.default_video_height), color='black')
-                photo = ImageTk.PhotoImage(black_img)
-                label.configure(image=photo)
-                label.image = photo
-
-                # 销毁框架
-                self.video_frames[participant_id]['frame'].destroy()
-                del self.video_frames[participant_id]
+        self.request_layout()
 
-                # 更新布局
-                self.container.update_idletasks()
-                self.update_layout()
-            except Exception as e:
-                print(f"移除视频时出错: {e}")
+    def _show_placeholder(self, label):
+        """显示黑色占位图"""
+        if self._black_photo is None:
+            self._black_photo = ImageTk.PhotoImage(
+                Image.new('RGB', (self.default_video_width, self.default_video_height), color='black'))
+        label.configure(image=self._black_photo)
+        label.image = self._black_photo
+
+    def _tile_photo(self, frame_info, size):
+        """视频框持续使用的PhotoImage，只有显示尺寸变化时才重新创建"""
+        photo = frame_info['photo']
+        if photo is None or (photo.width(), photo.height()) != size:
+            photo = frame_info['photo'] = ImageTk.PhotoImage('RGB', size)
+        if getattr(frame_info['label'], 'image', None) is not photo:
+            frame_info['label'].configure(image=photo)
+            frame_info['label'].image = photo
+        return photo
     
     def set_video_active(self, participant_id, active):
         """设置视频状态"""
@@ -108,18 +130,10 @@ class VideoGridManager:
             try:
                 self.video_frames[participant_id]['active'] = active
                 if not active:
-                    # 清除现有图像
-                    label = self.video_frames[participant_id]['label']
-                    label.configure(image='')
-                    label.image = None
-                    
                     # 显示黑色背景
-                    black_img = Image.new('RGB', (self.default_video_width, self.default_video_height), color='black')
-                    photo = ImageTk.PhotoImage(black_img)
-                    label.configure(image=photo)
-                    label.image = photo
+                    self._show_placeholder(self.video_frames[participant_id]['label'])
                     
-                self.update_layout()
+                self.request_layout()
             except Exception as e:
                 print(f"设置视频状态时出错: {e}")
     
@@ -133,14 +147,31 @@ class VideoGridManager:
             
         frame_info = self.video_frames[participant_id]
         
-        # 调整图像大小并更新
-        resized_image = self._resize_image_for_layout(image)
-        photo = ImageTk.PhotoImage(resized_image)
-        frame_info['label'].configure(image=photo)
-        frame_info['label'].image = photo
-        
-        # 强制更新布局
-        self.container.update_idletasks()
+        # 调整图像大小后直接写入视频框已有的PhotoImage，不重新分配；重绘由Tk在空闲时统一完成
+        resized_image = self._resize_image_for_layout(participant_id, image)
+        self._tile_photo(frame_info, resized_image.size).paste(resized_image)
+
+    def set_hidden(self, hidden):
+        """窗口最小化或恢复，最小化时不订阅任何视频"""
+        if hidden == self.hidden:
+            return
+        self.hidden = hidden
+        self.request_layout()
+
+    def _layout_changed(self, visible_tiles, discover_size):
+        if visible_tiles == self.visible_tiles and discover_size == self.discover_size:
+            return
+        self.visible_tiles = visible_tiles
+        self.discover_size = discover_size
+        if self.on_layout_change:
+            self.on_layout_change(visible_tiles, discover_size)
+
+    def set_active_speakers(self, speakers):
+        """设置活跃发言者列表，发言者的视频框优先排在网格前面"""
+        if speakers == self.active_speakers:
+            return
+        self.active_speakers = list(speakers)
+        self.request_layout()
 
     def start_screen_share(self, sharer_id):
         """开始屏幕共享"""
@@ -160,6 +191,7 @@ class VideoGridManager:
             # 显示屏幕共享框架
             self.screen_share_frame.grid()
             self.video_grid.grid_remove()
+            self.request_layout()
 
             print("Screen share started successfully")
             return True
@@ -217,20 +249,22 @@ class VideoGridManager:
                 # 如果LANCZOS失败，尝试使用BILINEAR
                 resized_image = image.resize((new_width, new_height), Image.Resampling.BILINEAR)
 
-            # 创建PhotoImage并更新标签
+            # 尺寸不变时写入已有的PhotoImage，不重新分配
             try:
-                photo = ImageTk.PhotoImage(resized_image)
-                self.screen_share_label.configure(image=photo)
-                self.screen_share_label.image = photo  # 保持引用防止垃圾回收
+                photo = self._screen_photo
+                if photo is None or (photo.width(), photo.height()) != resized_image.size:
+                    photo = self._screen_photo = ImageTk.PhotoImage('RGB', resized_image.size)
+                photo.paste(resized_image)
+                if getattr(self.screen_share_label, 'image', None) is not photo:
+                    self.screen_share_label.configure(image=photo)
+                    self.screen_share_label.image = photo  # 保持引用防止垃圾回收
             except Exception as e:
                 print(f"更新图像显示失败: {e}")
                 return False
 
-            # 设置共享状态为活跃
+            # 设置共享状态为活跃，网格不可见时不订阅视频
             self.is_screen_sharing = True
-
-            # 确保更新显示
-            self.container.update_idletasks()
+            self._layout_changed({}, None)
             return True
 
         except Exception as e:
@@ -251,6 +285,7 @@ class VideoGridManager:
             if self.screen_share_label:
                 self.screen_share_label.configure(image='')
                 self.screen_share_label.image = None
+            self._screen_photo = None
 
             # 隐藏屏幕共享框架
             if self.screen_share_frame:
@@ -263,7 +298,7 @@ class VideoGridManager:
             self.is_screen_sharing = False
             self.screen_sharer_id = None
 
-            self.update_layout()
+            self.request_layout()
             print("Screen share stopped successfully")
             return True
         except Exception as e:
@@ -273,12 +308,39 @@ class VideoGridManager:
             self.screen_sharer_id = None
             return False
 
+    def request_layout(self):
+        """安排在Tk空闲时更新一次布局，同一显示帧内的多次变化合并为一次"""
+        if self._layout_id is None:
+            self._layout_id = self.container.after_idle(self._run_layout)
+
+    def _on_grid_resize(self, event=None):
+        """窗口大小变化：立即更新图像尺寸，停止调整一段时间后再重新布局，按新的视频框尺寸更新订阅"""
+        self._update_tile_geometry()
+        if self._resize_id is not None:
+            self.container.after_cancel(self._resize_id)
+        self._resize_id = self.container.after(VIDEO_RESIZE_DEBOUNCE_MS, self._resize_done)
+
+    def _resize_done(self):
+        self._resize_id = None
+        self.request_layout()
+
+    def _run_layout(self):
+        self._layout_id = None
+        # 会议界面可能已经销毁
+        if self.container.winfo_exists():
+            self.update_layout()
+
     def update_layout(self):
-        """更新视频网格布局"""
+        """更新视频网格布局，并通知当前需要订阅的视频"""
+        if self.hidden:
+            self._layout_changed({}, None)
+            return
+
         if self.is_screen_sharing:
             self.video_grid.grid_remove()
             if self.screen_share_frame:
                 self.screen_share_frame.grid(row=0, column=0, sticky='nsew')
+            self._layout_changed({}, None)
             return
             
         # 显示视频网格
@@ -291,7 +353,17 @@ class VideoGridManager:
                        if info.get('active', False)}
         
         if not active_videos:
+            self._shown_tiles = []
+            self._update_tile_geometry()
+            self._layout_changed({}, (self.default_video_width, self.default_video_height))
             return
+
+        # 活跃发言者排在最前面，其余保持加入顺序；超出上限的视频框隐藏且不再订阅
+        speaker_rank = {pid: rank for rank, pid in enumerate(self.active_speakers)}
+        ordered = sorted(active_videos.items(), key=lambda item: speaker_rank.get(item[0], len(speaker_rank)))
+        for pid, info in ordered[self.max_tiles:]:
+            info['frame'].grid_remove()
+        active_videos = dict(ordered[:self.max_tiles])
             
         # 计算网格布局
         n = len(active_videos)
@@ -319,17 +391,25 @@ class VideoGridManager:
             frame.configure(width=cell_width, height=cell_height)
             frame.grid(row=row, column=col, sticky='nsew', padx=2, pady=2)
 
-    def _resize_image_for_layout(self, image):
-        """调整图像大小以适应布局"""
+        self._shown_tiles = list(active_videos)
+        self._update_tile_geometry()
+        self._layout_changed({pid: (cell_width, cell_height) for pid in active_videos},
+                             (cell_width, cell_height))
+
+    def _update_tile_geometry(self, event=None):
+        """计算每个视频框的图像尺寸和缩放滤波器（在Tk线程调用，其他线程只读取结果）
+
+        只在布局变化（参与者加入/离开、发言者变化）和窗口大小变化时调用。
+        """
         # 获取容器的实际大小
         grid_width = self.video_grid.winfo_width() or self.container_width
         grid_height = self.video_grid.winfo_height() or self.container_height
         
-        # 计算活跃视频数量和网格布局
-        active_count = sum(1 for info in self.video_frames.values() 
-                         if info.get('active', False)) or 1
-        cols = math.ceil(math.sqrt(active_count))
-        rows = math.ceil(active_count / cols)
+        # 按显示的视频框数量计算网格布局
+        shown = self._shown_tiles
+        count = len(shown) or 1
+        cols = math.ceil(math.sqrt(count))
+        rows = math.ceil(count / cols)
         
         # 计算单个视频的目标尺寸
         target_width = max(self.default_video_width, grid_width // cols)
@@ -341,32 +421,65 @@ class VideoGridManager:
             target_width = int(target_height * aspect_ratio)
         else:
             target_height = int(target_width / aspect_ratio)
-        
-        return image.resize((target_width, target_height), Image.Resampling.LANCZOS)
+        self.image_size = (target_width, target_height)
+
+        # 只有一个视频框或当前主要发言者的视频框使用最高质量的滤波器，小视频框用最快的
+        spotlight = shown[0] if shown and (len(shown) == 1 or shown[0] in self.active_speakers[:1]) else None
+        tier = 'small' if target_width <= VIDEO_SMALL_TILE_WIDTH else 'tile'
+        self.tile_geometry = {
+            pid: (self.image_size, RESAMPLE_FILTERS[VIDEO_RESAMPLE['spotlight' if pid == spotlight else tier]])
+            for pid in shown
+        }
+
+    def render_params(self, participant_id):
+        """视频框的 (显示尺寸, 缩放滤波器)，可在任意线程调用"""
+        geometry = self.tile_geometry.get(participant_id)
+        if geometry is None:
+            return self.image_size, RESAMPLE_FILTERS[VIDEO_RESAMPLE['tile']]
+        return geometry
+
+    def _resize_image_for_layout(self, participant_id, image):
+        """调整图像大小以适应布局，解码线程已经按显示尺寸解码的图像不再缩放"""
+        size, resample = self.render_params(participant_id)
+        if image.size == size:
+            return image
+        return image.resize(size, resample)
     
     def remove_video(self, participant_id):
         """移除视频框"""
         if participant_id in self.video_frames:
             try:
-                # 清除图像
-                label = self.video_frames[participant_id]['label']
-                label.configure(image='')
-                label.image = None
-    
-                # 显示黑色背景
-                black_img = Image.new('RGB', (self.default_video_width, self.default_video_height), color='black')
-                photo = ImageTk.PhotoImage(black_img)
-                label.configure(image=photo)
-                label.image = photo
-    
-                # 销毁框架
+                # 销毁框架（连同其PhotoImage）
                 self.video_frames[participant_id]['frame'].destroy()
                 del self.video_frames[participant_id]
     
                 # 更新布局
-                self.container.update_idletasks()
-                self.update_layout()
+                self.request_layout()
                 print(f"Successfully removed video for participant {participant_id}")
             except Exception as e:
                 print(f"移除视频时出错: {e}")
-                
\ No newline at end of file
+                
+
+
+if __name__ == '__main__':
+    # 基准测试：各缩放档位把一帧摄像头JPEG解码到不同视频框尺寸的耗时
+    import time
+    from io import BytesIO
+    from VideoDecoder import decode_to_size
+    from config import camera_width, camera_height
+
+    source = Image.effect_noise((camera_width, camera_height), 64).convert('RGB')
+    buffer = BytesIO()
+    source.save(buffer, format='JPEG', quality=75)
+    jpeg = buffer.getvalue()
+    repeats = 50
+
+    print(f"source {camera_width}x{camera_height} JPEG, {len(jpeg)} bytes, {repeats} frames per case")
+    print(f"{'tiles':>5} {'tile size':>10} {'filter':>9} {'ms/frame':>9} {'ms/grid':>8}")
+    for tiles, size in ((1, (800, 450)), (4, (400, 225)), (9, (320, 180))):
+        for name, resample in RESAMPLE_FILTERS.items():
+            started = time.perf_counter()
+            for _ in range(repeats):
+                decode_to_size(jpeg, size, resample)
+            per_frame = (time.perf_counter() - started) / repeats * 1000
+            print(f"{tiles:>5} {size[0]:>4}x{size[1]:<5} {name:>9} {per_frame:>9.2f} {per_frame * tiles:>8.2f}")
@@ -1,15 +1,26 @@
 import asyncio
 from typing import Optional
+from urllib.parse import urlparse
 import socketio
 import uuid
-from protocol import Conference
+from protocol import (Conference, KIND_AUDIO, KIND_VIDEO, KIND_SCREEN, FLAG_MIXED, FLAG_DTX,
+                      pack_media_frame, unpack_media_header, media_payload)
+from AudioCodec import PCM16, CodecSet, available_codecs
+from MediaTransport import (Packetizer, Reassembler, MediaDatagramProtocol, PacketHeader, pack_hello,
+                            PACKET_HEADER, PACKET_HELLO)
+from config import (CAPTURE_RATE, CAPTURE_CHANNELS, CAPTURE_CHUNK, UDP_MEDIA_ENABLED, UDP_HELLO_ATTEMPTS,
+                    UDP_HELLO_TIMEOUT, MULTIPLEX_CONNECTION)
 
 class ConferenceClient:
-    def __init__(self, server_url):
-        # 创建socket客户端实例
+    def __init__(self, server_url, multiplexed=MULTIPLEX_CONNECTION):
+        # 创建socket客户端实例，多路复用模式下视频和屏幕共享事件也走主连接
         self.sio = socketio.AsyncClient()
-        self.video_sio = socketio.AsyncClient()
-        self.screen_sio = socketio.AsyncClient()
+        self.multiplexed = multiplexed
+        if multiplexed:
+            self.video_sio = self.screen_sio = self.sio
+        else:
+            self.video_sio = socketio.AsyncClient()
+            self.screen_sio = socketio.AsyncClient()
         
         # 基础属性
         self.server_url = server_url
@@ -17,6 +28,28 @@ class ConferenceClient:
         self.username = None
         self._join_future = None
         self._conference_list_future = None
+        self.stream_id = 0  # 服务器分配的媒体流ID，用于二进制媒体帧头部
+        self._stream_users = {}  # {stream_id: user_id}
+        self.audio_seq = 0  # 音频帧序号，供服务器抖动缓冲区排序
+        self.video_seq = 0
+        self.screen_seq = 0
+        self.audio_codec = PCM16  # 与服务器协商之前先发送原始PCM
+        self._audio_encoders = CodecSet(CAPTURE_RATE, CAPTURE_CHANNELS, CAPTURE_CHUNK)
+        self._audio_decoders = CodecSet()
+
+        # 可选的UDP媒体通道，加入会议后由服务器下发会话参数，未建立时所有媒体走Socket.IO
+        self.udp_transport = None
+        self._udp_pending = None  # 已发送登记、等待服务器确认的UDP通道，此时媒体仍走Socket.IO
+        self._packetizer: Optional[Packetizer] = None
+        self._reassembler = Reassembler()
+        self._media_channels = {
+            'audio': (KIND_AUDIO, self.sio),
+            'video': (KIND_VIDEO, self.video_sio),
+            'screen_share': (KIND_SCREEN, self.screen_sio),
+        }
+        self._media_handlers = {}  # {kind: handler}，UDP收到的帧交给与Socket.IO相同的处理函数
+        self.target_bitrate = None  # 服务器根据接收者带宽建议的视频码率（bits/s）
+        self._video_subscriptions = None  # 上次发送的视频订阅，避免重复发送
         
         # 生成唯一用户ID
         self.user_id = str(uuid.uuid4())
@@ -25,22 +58,39 @@ class ConferenceClient:
         @self.sio.event
         async def connect():
             print("Connected to main channel")
-            await self.sio.emit('register_connection', {'user_id': self.user_id})
+            await self.sio.emit('register_connection', {
+                'user_id': self.user_id,
+                'multiplexed': self.multiplexed,
+                'codecs': available_codecs(CAPTURE_RATE, CAPTURE_CHUNK),
+                'audio_format': {'rate': CAPTURE_RATE, 'channels': CAPTURE_CHANNELS, 'chunk': CAPTURE_CHUNK}
+            })
+
+        @self.sio.on('connection_registered')
+        async def on_connection_registered(data):
+            self.audio_codec = data.get('audio_codec', PCM16)
+            self.stream_id = data.get('stream_id', 0)
+            print(f"Negotiated audio codec: {self.audio_codec}")
+
+        @self.sio.on('bitrate_hint')
+        async def on_bitrate_hint(data):
+            self.target_bitrate = data.get('bitrate')
+
+        # 服务器的RTT探测，直接回应
+        async def on_bw_probe(data):
+            return True
+
+        self.video_sio.on('bw_probe', on_bw_probe)
+
+        @self.sio.on('media_session')
+        async def on_media_session(data):
+            if UDP_MEDIA_ENABLED:
+                await self.start_udp_media(data)
         
         @self.sio.event
         async def disconnect():
             print("Disconnected from main channel")
             self.conference = None
-
-        @self.video_sio.event
-        async def connect():
-            print("Connected to video channel")
-            await self.video_sio.emit('register_connection', {'user_id': self.user_id})
-
-        @self.screen_sio.event
-        async def connect():
-            print("Connected to screen channel")
-            await self.screen_sio.emit('register_connection', {'user_id': self.user_id})
+            self.stop_udp_media()
 
         # 会议事件处理器
         @self.sio.on('conference_created')
@@ -53,6 +103,7 @@ class ConferenceClient:
             if self.conference and data['conference_id'] == self.conference.id:
                 print("Conference was closed by creator")
                 self.conference = None
+                self.stop_udp_media()
                 if hasattr(self, 'master') and hasattr(self.master, 'on_conference_closed'):
                     await self.master.on_conference_closed()
 
@@ -60,6 +111,7 @@ class ConferenceClient:
         async def on_conference_joined(data):
             print(f"Joined conference: {data}")
             self.conference = Conference.from_dict(data)
+            self._video_subscriptions = None
             if self._join_future and not self._join_future.done():
                 self._join_future.set_result(True)
 
@@ -67,6 +119,7 @@ class ConferenceClient:
         async def on_participant_joined(data):
             if self.conference and data['conference_id'] == self.conference.id:
                 self.conference.participants[data['user_id']] = data['client_name']
+                self.conference.stream_ids[data['user_id']] = data.get('stream_id')
                 if hasattr(self, 'master') and hasattr(self.master, 'update_participant_list'):
                     self.master.update_participant_list()
 
@@ -88,14 +141,9 @@ class ConferenceClient:
             if self._conference_list_future and not self._conference_list_future.done():
                 self._conference_list_future.set_result(data)
 
-        @self.video_sio.event
-        async def connect():
-            print("Connected to video channel")
-            await self.video_sio.emit('register_connection', {'user_id': self.user_id})
-
-        @self.video_sio.event
-        async def disconnect():
-            print("Disconnected from video channel")
+        if not multiplexed:
+            self._setup_media_channel(self.video_sio, 'video')
+            self._setup_media_channel(self.screen_sio, 'screen')
 
         @self.video_sio.on('video')
         async def on_video(data):
@@ -103,15 +151,6 @@ class ConferenceClient:
                 await self.master.on_video_received(data)
 
         # 屏幕共享通道事件处理器
-        @self.screen_sio.event
-        async def connect():
-            print("Connected to screen channel")
-            await self.screen_sio.emit('register_connection', {'user_id': self.user_id})
-
-        @self.screen_sio.event
-        async def disconnect():
-            print("Disconnected from screen channel")
-
         @self.screen_sio.on('screen_share')
         async def on_screen_share(data):
             if hasattr(self, 'master') and hasattr(self.master, 'on_screen_share_received'):
@@ -123,21 +162,35 @@ class ConferenceClient:
             if hasattr(self, 'master') and hasattr(self.master, 'on_audio_received'):
                 await self.master.on_audio_received(data)
 
+    def _setup_media_channel(self, socket, name):
+        """独立的视频/屏幕共享连接：连接后向服务器登记所属用户"""
+        @socket.event
+        async def connect():
+            print(f"Connected to {name} channel")
+            await socket.emit('register_connection', {'user_id': self.user_id})
+
+        @socket.event
+        async def disconnect():
+            print(f"Disconnected from {name} channel")
+
     async def connect(self):
-        """连接到所有通道"""
+        """连接到服务器，多路复用模式下只建立一个连接，否则依次连接三个通道"""
         try:
             await self.sio.connect(f"{self.server_url}")
-            await self.video_sio.connect(f"{self.server_url}", socketio_path='video/socket.io')
-            await self.screen_sio.connect(f"{self.server_url}", socketio_path='screen/socket.io')
+            if not self.multiplexed:
+                await self.video_sio.connect(f"{self.server_url}", socketio_path='video/socket.io')
+                await self.screen_sio.connect(f"{self.server_url}", socketio_path='screen/socket.io')
         except Exception as e:
             print(f"Error connecting to server: {e}")
 
     async def disconnect(self):
         """断开所有连接"""
+        self.stop_udp_media()
         try:
             await self.sio.disconnect()
-            await self.video_sio.disconnect()
-            await self.screen_sio.disconnect()
+            if not self.multiplexed:
+                await self.video_sio.disconnect()
+                await self.screen_sio.disconnect()
         except Exception as e:
             print(f"Error disconnecting: {e}")
 
@@ -173,6 +226,7 @@ class ConferenceClient:
                 'user_id': self.user_id
             })
             self.conference = None
+            self.stop_udp_media()
 
     async def close_conference(self):
         """关闭会议（仅创建者可用）"""
@@ -213,40 +267,175 @@ class ConferenceClient:
                 'user_id': self.user_id
             })
 
+    async def start_udp_media(self, session):
+        """建立UDP媒体通道，并用服务器下发的令牌登记本机的UDP地址
+
+        收到服务器的确认（或第一个UDP数据报）后才把媒体切换到UDP；超时没有确认时关闭通道，
+        继续使用Socket.IO（例如UDP端口被防火墙拦截）。
+        """
+        self.stop_udp_media()
+        loop = asyncio.get_running_loop()
+        host = urlparse(self.server_url).hostname
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: MediaDatagramProtocol(self._on_udp_packet), remote_addr=(host, session['udp_port']))
+        except OSError as e:
+            print(f"UDP media unavailable, using Socket.IO: {e}")
+            return
+        self._udp_pending = transport
+        self._packetizer = Packetizer(session['stream_id'])
+        self._reassembler = Reassembler()
+        hello = pack_hello(session['stream_id'], session['token'])
+        # 登记数据报可能丢失，在超时时间内间隔发送几次
+        for _ in range(UDP_HELLO_ATTEMPTS):
+            if self._udp_pending is not transport:
+                break
+            transport.sendto(hello)
+            await asyncio.sleep(UDP_HELLO_TIMEOUT / UDP_HELLO_ATTEMPTS)
+        if self.udp_transport is transport:
+            print(f"UDP media session started on port {session['udp_port']}")
+        elif self._udp_pending is transport:
+            print("UDP media not acknowledged, using Socket.IO")
+            self.stop_udp_media()
+
+    def stop_udp_media(self):
+        """关闭UDP媒体通道，之后的媒体帧回到Socket.IO"""
+        for transport in (self.udp_transport, self._udp_pending):
+            if transport:
+                transport.close()
+        self.udp_transport = self._udp_pending = None
+        self._packetizer = None
+
+    def _on_udp_packet(self, packet, addr):
+        """重组UDP分片，完整的媒体帧交给对应的处理函数"""
+        if len(packet) < PACKET_HEADER.size:
+            return
+        if self.udp_transport is None:
+            if self._udp_pending is None:
+                return
+            # 服务器的确认或转发的媒体说明地址已经登记，之后的媒体帧改走UDP
+            self.udp_transport, self._udp_pending = self._udp_pending, None
+        header = PacketHeader(packet)
+        if header.ptype == PACKET_HELLO:
+            return
+        result = self._reassembler.add(packet, header)
+        if result is None:
+            return
+        kind, frame = result
+        handler = self._media_handlers.get(kind)
+        if handler:
+            asyncio.ensure_future(handler(frame))
+
+    def on_media(self, event, handler):
+        """注册媒体帧（'audio'、'video'、'screen_share'）的处理函数，Socket.IO和UDP共用"""
+        kind, socket = self._media_channels[event]
+        socket.on(event, handler)
+        self._media_handlers[kind] = handler
+
+    def transport_backlog(self, event):
+        """发送某个媒体通道的连接中尚未写出的数据包数；UDP数据报不排队，返回0"""
+        if self.udp_transport:
+            return 0
+        _, socket = self._media_channels[event]
+        try:
+            return socket.eio.queue.qsize()
+        except AttributeError:
+            return 0
+
+    async def _send_media(self, event, frame, layer=0):
+        """有UDP媒体通道时分片发送，否则通过对应的Socket.IO通道发送"""
+        kind, socket = self._media_channels[event]
+        if self.udp_transport:
+            for packet in self._packetizer.packetize(kind, frame, layer):
+                self.udp_transport.sendto(packet)
+        else:
+            await socket.emit(event, frame)
+
     async def send_video(self, video_data):
-        """发送视频数据"""
+        """发送视频数据，video_data['layers']为联播的各层（第0层为原始尺寸），同一帧的各层使用相同序号"""
         if self.conference:
-            await self.video_sio.emit('video', {
-                'conference_id': self.conference.id,
-                'data': video_data['data'] if isinstance(video_data, dict) else video_data,
-                'user_id': self.user_id
-            })
+            self.video_seq += 1
+            if isinstance(video_data, dict) and 'layers' in video_data:
+                layers = video_data['layers']
+            else:
+                layers = [video_data['data'] if isinstance(video_data, dict) else video_data]
+            # 原始尺寸的层先发，服务器选择层时不会只看到缩略图
+            for layer, payload in enumerate(layers):
+                await self._send_media('video', pack_media_frame(KIND_VIDEO, self.stream_id, self.video_seq,
+                                                                 payload, extra=layer), layer)
 
     async def send_screen_share(self, screen_data):
         """发送屏幕共享数据"""
         if self.conference:
-            await self.screen_sio.emit('screen_share', {
-                'conference_id': self.conference.id,
-                'data': screen_data['data'] if isinstance(screen_data, dict) else screen_data,
-                'user_id': self.user_id
-            })
+            self.screen_seq += 1
+            payload = screen_data['data'] if isinstance(screen_data, dict) else screen_data
+            await self._send_media('screen_share',
+                                   pack_media_frame(KIND_SCREEN, self.stream_id, self.screen_seq, payload))
 
     async def send_audio(self, audio_data):
         """发送音频数据"""
         if self.conference:
-            await self.sio.emit('audio', {
-                'conference_id': self.conference.id,
-                'data': audio_data['data'] if isinstance(audio_data, dict) else audio_data,
-                'user_id': self.user_id
-            })
+            self.audio_seq += 1
+            if isinstance(audio_data, dict) and audio_data.get('dtx'):
+                # 静音期间的保活标记，不携带音频数据
+                await self._send_media('audio', pack_media_frame(KIND_AUDIO, self.stream_id, self.audio_seq,
+                                                                 flags=FLAG_DTX))
+                return
+            pcm = audio_data['data'] if isinstance(audio_data, dict) else audio_data
+            payload = self._audio_encoders.encode(self.audio_codec, pcm)
+            await self._send_media('audio', pack_media_frame(KIND_AUDIO, self.stream_id, self.audio_seq, payload,
+                                                             extra=self.audio_codec))
+
+    def user_for_stream(self, stream_id):
+        """根据媒体流ID查找发送者"""
+        user_id = self._stream_users.get(stream_id)
+        if user_id is None and self.conference:
+            self._stream_users = {sid: uid for uid, sid in self.conference.stream_ids.items()}
+            user_id = self._stream_users.get(stream_id)
+        return user_id
+
+    def unpack_media(self, frame):
+        """把二进制媒体帧解析为界面使用的字典，不在当前会议中时返回None"""
+        if not self.conference:
+            return None
+        header = unpack_media_header(frame)
+        return {
+            'conference_id': self.conference.id,
+            'user_id': self.user_for_stream(header.stream_id),
+            'data': media_payload(frame),
+            'seq': header.seq,
+            'timestamp': header.timestamp,
+            'codec': header.extra,
+            'layer': header.extra if header.kind == KIND_VIDEO else 0,
+            'mixed': bool(header.flags & FLAG_MIXED),
+        }
+
+    def decode_audio(self, data):
+        """按数据中的编解码器ID解码收到的音频，返回可直接播放的16位PCM"""
+        return self._audio_decoders.decode(data['codec'], data['data']).tobytes()
+
+    async def subscribe_video(self, subscriptions):
+        """声明当前显示的视频及其窗口大小 {user_id: (width, height)}，服务器只转发这些视频"""
+        if not self.conference:
+            return
+        subscriptions = {user_id: list(size) for user_id, size in subscriptions.items()}
+        if subscriptions == self._video_subscriptions:
+            return
+        self._video_subscriptions = subscriptions
+        await self.video_sio.emit('video_subscribe', {
+            'conference_id': self.conference.id,
+            'user_id': self.user_id,
+            'subscriptions': subscriptions
+        })
 
     async def notify_video_stopped(self):
-        """通知其他用户视频已停止"""
+        """通知其他用户视频已停止，seq为最后发出的视频帧序号"""
         if self.conference:
             # 通过video_sio发送停止信号
             await self.video_sio.emit('video_stopped', {
                 'conference_id': self.conference.id,
-                'user_id': self.user_id
+                'user_id': self.user_id,
+                'seq': self.video_seq
             })
     
     async def notify_screen_share_stopped(self):
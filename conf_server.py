@@ -1,9 +1,21 @@
+import asyncio
+import secrets
+import time
 from typing import Dict
 import uuid
 import socketio
 from aiohttp import web
-from protocol import Conference
-from AudioMixer import AudioMixer
+from protocol import (Conference, KIND_AUDIO, KIND_VIDEO, KIND_SCREEN, FLAG_MIXED, FLAG_DTX, SERVER_STREAM_ID,
+                      pack_media_frame, unpack_media_header, media_payload)
+from AudioMixer import AudioMixer, MixScheduler, FRAME_DURATION
+from AudioCodec import PCM16, available_codecs, negotiate_codec
+from BandwidthEstimator import BandwidthEstimator
+from EgressScheduler import EgressQueue, AUDIO, CONTROL, VIDEO, SCREEN, transport_backlog
+from Transcoder import Transcoder
+from MediaTransport import (Packetizer, Reassembler, MediaDatagramProtocol, PacketHeader,
+                            PACKET_HEADER, PACKET_HELLO)
+from config import (CHUNK, RATE, UDP_MEDIA_ENABLED, UDP_MEDIA_PORT, EGRESS_MAX_BACKLOG, BWE_INTERVAL,
+                    BWE_AUDIO_RESERVE_BPS, BITRATE_HINT_CHANGE, SIMULCAST_LAYERS, TRANSCODE_ENABLED, camera_width)
 
 # 创建三个不同的socket服务器
 sio = socketio.AsyncServer(async_mode='aiohttp', ping_timeout=3, ping_interval=25)
@@ -16,11 +28,496 @@ sio.attach(app, socketio_path='socket.io')
 video_sio.attach(app, socketio_path='video/socket.io')
 screen_sio.attach(app, socketio_path='screen/socket.io')
 
+# 视频/屏幕共享帧的转发通道：{kind: (event, connection, priority)}
+MEDIA_CHANNELS = {
+    KIND_VIDEO: ('video', 'video', VIDEO),
+    KIND_SCREEN: ('screen_share', 'screen', SCREEN),
+}
+CHANNEL_SERVERS = {'main': sio, 'video': video_sio, 'screen': screen_sio}
+
 # 存储数据
 conferences: Dict[str, Conference] = {}
-user_connections = {}  # {user_id: {'main': sid, 'video': sid, 'screen': sid}}
+user_connections = {}  # {user_id: {'main': sid, 'video': sid, 'screen': sid, 'multiplexed': bool}}
+user_codecs = {}  # {user_id: codec_id}，注册时协商的音频编解码器
+user_audio_formats = {}  # {user_id: (rate, channels, chunk)}，客户端声明的采集格式
+user_conferences = {}  # {user_id: conf_id}，用户当前所在的会议
+stream_ids = {}  # {user_id: stream_id}，二进制媒体帧头部中标识发送者的小整数
+stream_owners = {}  # {stream_id: user_id}
+egress_queues = {}  # {user_id: EgressQueue}，每个用户的下行发送调度器
+bandwidth_estimators = {}  # {user_id: BandwidthEstimator}，每个接收者的下行带宽估计
+_bandwidth_samples = {}  # {user_id: (bytes_sent, backlog)}，上一个估计周期结束时的发送量
+bitrate_hints = {}  # {user_id: bits/s}，上次发给发布者的目标码率
+video_publishers = {}  # {user_id: 最近一次发送视频/屏幕共享的时间}
+
+# 联播：发布者的各层码率，以及每个订阅者为每个发布者选择的层（0为原始尺寸）
+publisher_layers = {}  # {publisher_id: {layer: bits/s}}，上一个估计周期测得的各层码率
+_layer_bytes = {}  # {publisher_id: {layer: bytes}}，本周期累计的各层字节数
+subscriber_layers = {}  # {subscriber_id: {publisher_id: layer}}
+video_subscriptions = {}  # {subscriber_id: {publisher_id: (width, height)}}，订阅者正在显示的视频及窗口大小
+
+# 可选的服务器端转码：不支持联播的发布者的帧缩小后发给窗口较小或带宽不足的订阅者
+transcoder = None
+subscriber_transcodes = {}  # {subscriber_id: {publisher_id: width}}，只记录需要转码的订阅
+_next_stream_id = SERVER_STREAM_ID
 
 audio_mixers = {}
+mix_scheduler = MixScheduler()  # 所有会议共用一个定时混音循环
+audio_mix_task = None
+
+# 可选的UDP媒体通道
+udp_transport = None
+udp_addrs = {}  # {user_id: (host, port)}，已用令牌登记的UDP地址
+udp_tokens = {}  # {user_id: token}，加入会议时下发
+udp_reassembler = Reassembler()
+# 服务器自己分片的数据报（混音、Socket.IO收到的帧和转码后的帧）都使用流ID 0和同一个帧序号空间，
+# 接收端按 (流ID, 帧序号) 重组时不会与客户端直接中继的数据报混淆
+server_packetizer = Packetizer(SERVER_STREAM_ID)
+
+def assign_stream_id(user_id):
+    """为用户分配媒体流ID（0保留给服务器混音）"""
+    global _next_stream_id
+    if user_id in stream_ids:
+        return stream_ids[user_id]
+    for _ in range(0xFFFF):
+        _next_stream_id = _next_stream_id % 0xFFFF + 1
+        if _next_stream_id not in stream_owners:
+            break
+    else:
+        raise RuntimeError("No free media stream id")
+    stream_ids[user_id] = _next_stream_id
+    stream_owners[_next_stream_id] = user_id
+    return _next_stream_id
+
+def release_stream_id(user_id):
+    """用户断开连接后释放其媒体流ID"""
+    stream_id = stream_ids.pop(user_id, None)
+    if stream_id is not None:
+        stream_owners.pop(stream_id, None)
+
+def media_sender(frame):
+    """解析媒体帧头部，返回 (header, user_id, conf_id)，发送者不在会议中时返回None"""
+    header = unpack_media_header(frame)
+    user_id = stream_owners.get(header.stream_id)
+    conf_id = user_conferences.get(user_id)
+    if not user_id or conf_id not in conferences:
+        return None
+    return header, user_id, conf_id
+
+def media_socket(user_id, connection):
+    """返回向用户发送某个通道事件的 (server, sid)，多路复用的用户只有主连接"""
+    connections = user_connections.get(user_id, {})
+    if connections.get('multiplexed'):
+        return sio, connections.get('main')
+    return CHANNEL_SERVERS[connection], connections.get(connection)
+
+def egress(user_id) -> EgressQueue:
+    """用户的下行发送调度器，音频、控制消息、视频和屏幕共享按优先级发送"""
+    queue = egress_queues.get(user_id)
+    if queue is None:
+        async def send(event, data, connection):
+            server, sid = media_socket(user_id, connection)
+            if sid:
+                await server.emit(event, data, to=sid)
+
+        def backlog(connection):
+            return transport_backlog(*media_socket(user_id, connection))
+
+        queue = egress_queues[user_id] = EgressQueue(send, backlog)
+    return queue
+
+def close_egress(user_id):
+    queue = egress_queues.pop(user_id, None)
+    if queue:
+        queue.close()
+    bandwidth_estimators.pop(user_id, None)
+    _bandwidth_samples.pop(user_id, None)
+    bitrate_hints.pop(user_id, None)
+    video_publishers.pop(user_id, None)
+    publisher_layers.pop(user_id, None)
+    _layer_bytes.pop(user_id, None)
+    subscriber_layers.pop(user_id, None)
+    video_subscriptions.pop(user_id, None)
+    subscriber_transcodes.pop(user_id, None)
+    forget_publisher(user_id)
+    if transcoder:
+        transcoder.forget(user_id)
+
+def forget_publisher(publisher_id):
+    """从其他订阅者的订阅、联播层和转码选择中删除已离开的发布者"""
+    for subscriptions in (video_subscriptions, subscriber_layers, subscriber_transcodes):
+        for publishers in subscriptions.values():
+            publishers.pop(publisher_id, None)
+
+async def join_media_rooms(user_id, conf_id):
+    """让用户的连接加入会议房间；独立的视频/屏幕连接如果还没有登记，会在登记时补加入"""
+    connections = user_connections.get(user_id, {})
+    main_sid = connections.get('main')
+    if main_sid:
+        await sio.enter_room(main_sid, conf_id)
+    if connections.get('multiplexed'):
+        return
+    for connection in ('video', 'screen'):
+        sid = connections.get(connection)
+        if sid:
+            await CHANNEL_SERVERS[connection].enter_room(sid, conf_id)
+            print(f"{connection.capitalize()} socket {sid} joined room {conf_id}")
+
+async def leave_media_rooms(user_id, conf_id):
+    connections = user_connections.get(user_id, {})
+    main_sid = connections.get('main')
+    if main_sid:
+        await sio.leave_room(main_sid, conf_id)
+    if connections.get('multiplexed'):
+        return
+    for connection in ('video', 'screen'):
+        sid = connections.get(connection)
+        if sid:
+            await CHANNEL_SERVERS[connection].leave_room(sid, conf_id)
+
+def send_channel_event(kind, event, data, conf_id, sender_id):
+    """通过各用户的发送调度器通知视频/屏幕通道上的控制事件，
+    并丢弃该发送者尚未发出的帧，避免关闭后又显示旧画面"""
+    _, connection, priority = MEDIA_CHANNELS[kind]
+    for user_id in conferences[conf_id].participants:
+        if user_id == sender_id:
+            continue
+        queue = egress(user_id)
+        queue.discard(priority, sender_id)
+        queue.put(CONTROL, event, data, connection)
+
+async def start_media_session(sid, user_id):
+    """加入会议后下发UDP媒体会话参数，客户端用令牌登记自己的UDP地址"""
+    if udp_transport is None:
+        return
+    token = udp_tokens.setdefault(user_id, secrets.token_hex(8))
+    await sio.emit('media_session', {
+        'udp_port': UDP_MEDIA_PORT,
+        'stream_id': stream_ids[user_id],
+        'token': token
+    }, to=sid)
+
+def end_media_session(user_id):
+    udp_addrs.pop(user_id, None)
+    udp_tokens.pop(user_id, None)
+
+def send_udp(user_ids, packets):
+    """把数据报发送给已登记UDP地址的用户"""
+    for user_id in user_ids:
+        addr = udp_addrs.get(user_id)
+        if addr:
+            for packet in packets:
+                udp_transport.sendto(packet, addr)
+
+def on_udp_packet(packet, addr):
+    """处理一个UDP数据报
+
+    视频和屏幕共享分片（包括校验分片）收到后立即转发给其他UDP用户，由接收端重组；
+    服务器同时重组出完整帧，音频交给混音器，视频转发给没有UDP通道的用户。
+    """
+    if len(packet) < PACKET_HEADER.size:
+        return
+    header = PacketHeader(packet)
+    user_id = stream_owners.get(header.stream_id)
+    if header.ptype == PACKET_HELLO:
+        token = udp_tokens.get(user_id)
+        if token and packet[PACKET_HEADER.size:] == token.encode():
+            udp_addrs[user_id] = addr
+            # 确认登记，客户端收到后才把媒体切换到UDP
+            udp_transport.sendto(packet, addr)
+        return
+    # 只接受已登记地址发来的数据报
+    if not user_id or udp_addrs.get(user_id) != addr:
+        return
+    conf_id = user_conferences.get(user_id)
+    conf = conferences.get(conf_id)
+    if not conf:
+        return
+
+    if header.kind in MEDIA_CHANNELS:
+        send_udp([uid for uid in conf.participants
+                  if uid != user_id and wants_layer(uid, user_id, header.kind, header.layer)], [packet])
+    result = udp_reassembler.add(packet, header)
+    if result is None:
+        return
+    kind, frame = result
+    if kind == KIND_AUDIO:
+        receive_audio(frame)
+    elif kind in MEDIA_CHANNELS:
+        forward_media(kind, frame, relayed=True)
+
+async def start_udp_media(app):
+    global udp_transport
+    if not UDP_MEDIA_ENABLED:
+        return
+    loop = asyncio.get_running_loop()
+    udp_transport, _ = await loop.create_datagram_endpoint(
+        lambda: MediaDatagramProtocol(on_udp_packet), local_addr=('0.0.0.0', UDP_MEDIA_PORT))
+    print(f"UDP media plane listening on port {UDP_MEDIA_PORT}")
+
+async def stop_udp_media(app):
+    if udp_transport:
+        udp_transport.close()
+
+async def probe_rtt(user_id, estimator):
+    """在视频连接上发送RTT探测，与视频帧经过同一个发送队列，能反映排队延迟"""
+    server, sid = media_socket(user_id, 'video')
+    if not sid:
+        return
+    sent = time.monotonic()
+    try:
+        await server.call('bw_probe', {}, to=sid, timeout=BWE_INTERVAL * 4)
+    except socketio.exceptions.TimeoutError:
+        # 回应过探测的客户端超时说明严重拥塞；不支持探测的旧客户端不计入
+        if estimator.srtt is not None:
+            estimator.on_rtt(BWE_INTERVAL * 4)
+        return
+    except Exception:
+        return
+    estimator.on_rtt(time.monotonic() - sent)
+
+def update_bandwidth(user_id, queue, interval):
+    """用一个周期内实际写出的字节数和排队延迟更新接收者的带宽估计，并作为发送预算"""
+    estimator = bandwidth_estimators.get(user_id)
+    if estimator is None:
+        estimator = bandwidth_estimators[user_id] = BandwidthEstimator()
+    asyncio.ensure_future(probe_rtt(user_id, estimator))
+    backlog = transport_backlog(*media_socket(user_id, 'video'))
+    last_sent, last_backlog = _bandwidth_samples.get(user_id, (queue.bytes_sent, backlog))
+    _bandwidth_samples[user_id] = (queue.bytes_sent, backlog)
+    # 交给连接的字节数减去其中仍在积压的部分，即为本周期写出的字节数
+    delivered = queue.bytes_sent - last_sent - (backlog - last_backlog) * queue.mean_size
+    queue.set_rate(estimator.update(max(0.0, delivered), interval, backlog > EGRESS_MAX_BACKLOG))
+
+def active_publishers(conf):
+    now = time.monotonic()
+    return [user_id for user_id in conf.participants
+            if now - video_publishers.get(user_id, 0) < BWE_INTERVAL * 4]
+
+def bandwidth_share(subscriber_id, publishers):
+    """订阅者的带宽预算（扣除音频）平分给它接收的每个发布者，没有带宽估计时返回None"""
+    estimator = bandwidth_estimators.get(subscriber_id)
+    if estimator is None:
+        return None
+    count = sum(1 for user_id in publishers if user_id != subscriber_id)
+    return max(0, estimator.estimate - BWE_AUDIO_RESERVE_BPS) / max(1, count)
+
+def layer_width(layer):
+    """联播层的标称宽度"""
+    scale = SIMULCAST_LAYERS[layer][0] if layer < len(SIMULCAST_LAYERS) else SIMULCAST_LAYERS[-1][0]
+    return camera_width * scale
+
+def select_layer(subscriber_id, publisher_id, share=None):
+    """为订阅者选择发布者的联播层
+
+    先排除比订阅者窗口大得多的层（保留能覆盖窗口的最小一层及更小的层），
+    再在其中选择码率不超过订阅者带宽份额的最大一层，都超出时选最小的一层。
+    """
+    rates = publisher_layers.get(publisher_id)
+    if not rates:
+        return 0
+    candidates = sorted(rates)  # 层号越小尺寸越大
+    tile = video_subscriptions.get(subscriber_id, {}).get(publisher_id)
+    if tile:
+        covering = [layer for layer in candidates if layer_width(layer) >= tile[0]]
+        smallest_covering = max(covering) if covering else candidates[0]
+        candidates = [layer for layer in candidates if layer >= smallest_covering]
+    if share is not None:
+        for layer in candidates:
+            if rates[layer] <= share:
+                return layer
+        return candidates[-1]
+    return candidates[0]
+
+def wants_layer(subscriber_id, publisher_id, kind, layer):
+    """订阅者当前是否接收发布者的这一层
+
+    屏幕共享没有联播，总是接收；声明过视频订阅的订阅者只接收订阅了的发布者，
+    没有声明过的旧客户端接收所有发布者。
+    """
+    if kind != KIND_VIDEO:
+        return True
+    subscriptions = video_subscriptions.get(subscriber_id)
+    if subscriptions is not None and publisher_id not in subscriptions:
+        return False
+    if publisher_id in subscriber_transcodes.get(subscriber_id, {}):
+        # 由服务器转码后另行发送
+        return False
+    selected = subscriber_layers.get(subscriber_id, {}).get(publisher_id)
+    if selected is None:
+        # 发布者的各层可能还没有全部到达，先按已知的层选择但不缓存，由下一次update_layer_selection确定
+        selected = select_layer(subscriber_id, publisher_id)
+    return selected == layer
+
+def select_transcode_width(subscriber_id, publisher_id, share=None):
+    """为订阅者选择不支持联播的发布者的转码宽度，原始帧合适时返回None
+
+    与select_layer相同：先排除比订阅者窗口大得多的档位，再选择码率不超过带宽份额的最大一档，
+    各档码率按面积比例由原始帧的码率估算。
+    """
+    rates = publisher_layers.get(publisher_id)
+    if transcoder is None or not rates or len(rates) > 1:
+        return None
+    # 还没有转码过时按摄像头分辨率估计原图宽度
+    source_width = transcoder.source_widths.get(publisher_id, camera_width)
+    candidates = [source_width] + [width for width in transcoder.widths if width < source_width]
+    tile = video_subscriptions.get(subscriber_id, {}).get(publisher_id)
+    if tile:
+        covering = [width for width in candidates if width >= tile[0]]
+        candidates = candidates[candidates.index(covering[-1]):] if covering else candidates[:1]
+    width = candidates[0]
+    rate = rates.get(0)
+    if share is not None and rate:
+        fitting = [width for width in candidates if rate * (width / source_width) ** 2 <= share]
+        width = fitting[0] if fitting else candidates[-1]
+    return None if width == source_width else width
+
+def update_transcodes(subscriber_id, publishers, share):
+    transcodes = {}
+    for publisher in publishers:
+        if publisher != subscriber_id:
+            width = select_transcode_width(subscriber_id, publisher, share)
+            if width is not None:
+                transcodes[publisher] = width
+    subscriber_transcodes[subscriber_id] = transcodes
+
+def record_layer(publisher_id, layer, nbytes):
+    """累计发布者各层的字节数，新出现的层立即可供选择"""
+    _layer_bytes.setdefault(publisher_id, {})
+    _layer_bytes[publisher_id][layer] = _layer_bytes[publisher_id].get(layer, 0) + nbytes
+    publisher_layers.setdefault(publisher_id, {}).setdefault(layer, 0.0)
+
+def update_layer_selection(conf, interval):
+    """用本周期测得的各层码率和订阅者的带宽份额重新为每个订阅者选择层"""
+    publishers = active_publishers(conf)
+    for publisher in publishers:
+        counted = _layer_bytes.pop(publisher, {})
+        if counted:
+            publisher_layers[publisher] = {layer: nbytes * 8 / interval for layer, nbytes in counted.items()}
+    for subscriber in conf.participants:
+        share = bandwidth_share(subscriber, publishers)
+        layers = subscriber_layers.setdefault(subscriber, {})
+        for publisher in publishers:
+            if publisher != subscriber and publisher in publisher_layers:
+                layers[publisher] = select_layer(subscriber, publisher, share)
+        if transcoder:
+            update_transcodes(subscriber, publishers, share)
+
+@sio.on('video_subscribe')
+@video_sio.on('video_subscribe')
+async def handle_video_subscribe(sid, data):
+    """订阅者声明正在显示的视频及窗口大小，服务器只转发这些视频并按窗口大小选择联播层"""
+    try:
+        user_id = data.get('user_id')
+        conf_id = data['conference_id']
+        conf = conferences.get(conf_id)
+        if not user_id or not conf or user_id not in conf.participants:
+            return
+        subscriptions = {publisher_id: tuple(size) for publisher_id, size in data.get('subscriptions', {}).items()
+                         if publisher_id in conf.participants and publisher_id != user_id}
+        previous = video_subscriptions.get(user_id, {})
+        video_subscriptions[user_id] = subscriptions
+
+        # 取消订阅的发布者：丢弃已排队的帧
+        queue = egress_queues.get(user_id)
+        for publisher_id in previous:
+            if publisher_id not in subscriptions and queue:
+                queue.discard(VIDEO, publisher_id)
+        # 窗口大小变化后立即重新选择联播层
+        publishers = active_publishers(conf)
+        share = bandwidth_share(user_id, publishers)
+        layers = subscriber_layers.setdefault(user_id, {})
+        for publisher_id in subscriptions:
+            if publisher_id in publisher_layers:
+                layers[publisher_id] = select_layer(user_id, publisher_id, share)
+        if transcoder:
+            update_transcodes(user_id, publishers, share)
+            # 新订阅的窗口立即显示缓存的最新一帧
+            for publisher_id, width in subscriber_transcodes[user_id].items():
+                frame = transcoder.latest(publisher_id, width)
+                if frame and publisher_id not in previous:
+                    deliver_media(KIND_VIDEO, frame, publisher_id, [user_id])
+    except Exception as e:
+        print(f"Error handling video subscription: {e}")
+
+def send_bitrate_hints(conf):
+    """计算每个发布者的目标码率并通过控制通道通知它
+
+    每个接收者的预算（扣除音频）平分给它接收的所有发布者。单层发布者取所有接收者中最小的
+    一份，使最差链路上的接收者也能收到完整的帧；联播发布者（或开启了服务器转码时）取最大的
+    一份，较差的接收者由服务器改发小层或转码后的帧。UDP接收者没有带宽估计，不参与计算。
+    """
+    publishers = active_publishers(conf)
+    for publisher in publishers:
+        shares = [bandwidth_share(receiver, publishers) for receiver in conf.participants
+                  if receiver != publisher and receiver in bandwidth_estimators]
+        if not shares:
+            continue
+        scalable = len(publisher_layers.get(publisher, {})) > 1 or transcoder is not None
+        hint = max(shares) if scalable else min(shares)
+        last = bitrate_hints.get(publisher)
+        if last is None or abs(hint - last) > last * BITRATE_HINT_CHANGE:
+            bitrate_hints[publisher] = hint
+            egress(publisher).put(CONTROL, 'bitrate_hint', {'bitrate': int(hint)})
+
+async def bandwidth_loop():
+    """定期更新所有接收者的带宽估计，并向发布者发送目标码率"""
+    loop = asyncio.get_running_loop()
+    last = loop.time()
+    while True:
+        await asyncio.sleep(BWE_INTERVAL)
+        now = loop.time()
+        try:
+            for user_id, queue in list(egress_queues.items()):
+                if user_id in user_conferences:
+                    update_bandwidth(user_id, queue, now - last)
+            for conf in list(conferences.values()):
+                update_layer_selection(conf, now - last)
+                send_bitrate_hints(conf)
+        except Exception as e:
+            print(f"Error in bandwidth loop: {e}")
+        last = now
+
+async def start_bandwidth_control(app):
+    app['bandwidth_task'] = asyncio.create_task(bandwidth_loop())
+
+async def stop_bandwidth_control(app):
+    app['bandwidth_task'].cancel()
+
+async def start_transcoding(app):
+    global transcoder
+    if TRANSCODE_ENABLED:
+        transcoder = Transcoder()
+
+async def stop_transcoding(app):
+    if transcoder:
+        transcoder.close()
+
+async def media_stats(request):
+    """各接收者的下行队列深度、延迟和丢帧统计"""
+    return web.json_response({
+        'egress': {user_id: queue.stats() for user_id, queue in egress_queues.items()},
+        'bandwidth': {user_id: estimator.stats() for user_id, estimator in bandwidth_estimators.items()},
+        'bitrate_hints': {user_id: int(hint) for user_id, hint in bitrate_hints.items()},
+        'subscriber_layers': subscriber_layers,
+        'video_subscriptions': {user_id: list(subscriptions) for user_id, subscriptions in video_subscriptions.items()},
+        'transcodes': subscriber_transcodes,
+        'transcoder': transcoder.stats() if transcoder else None,
+        'udp': {
+            'users': len(udp_addrs),
+            'completed_frames': udp_reassembler.completed_frames,
+            'recovered_fragments': udp_reassembler.recovered_fragments,
+            'expired_frames': udp_reassembler.expired_frames,
+        },
+    })
+
+app.router.add_get('/stats', media_stats)
+app.on_startup.append(start_udp_media)
+app.on_startup.append(start_bandwidth_control)
+app.on_startup.append(start_transcoding)
+app.on_cleanup.append(stop_udp_media)
+app.on_cleanup.append(stop_bandwidth_control)
+app.on_cleanup.append(stop_transcoding)
+
 # 连接事件处理
 @sio.event
 async def connect(sid, environ):
@@ -33,11 +530,20 @@ async def disconnect(sid):
     for user_id, connections in user_connections.items():
         if connections.get('main') == sid:
             print(f"Cleaning up connections for user {user_id}")
+            end_media_session(user_id)
+            close_egress(user_id)
+            release_stream_id(user_id)
+            user_codecs.pop(user_id, None)
+            user_audio_formats.pop(user_id, None)
             # 检查并清理会议参与者信息
             for conf in conferences.values():
                 if user_id in conf.participants:
                     client_name = conf.participants[user_id]
                     del conf.participants[user_id]
+                    conf.stream_ids.pop(user_id, None)
+                    user_conferences.pop(user_id, None)
+                    if conf.id in audio_mixers:
+                        audio_mixers[conf.id].remove_audio_stream(user_id)
                     await sio.emit('participant_left', {
                         'conference_id': conf.id,
                         'user_id': user_id,
@@ -69,6 +575,27 @@ async def register_main_connection(sid, data):
         if user_id not in user_connections:
             user_connections[user_id] = {}
         user_connections[user_id]['main'] = sid
+        # 多路复用模式：视频和屏幕共享作为主连接上的逻辑流，不再有独立连接
+        multiplexed = bool(data.get('multiplexed'))
+        user_connections[user_id]['multiplexed'] = multiplexed
+        if multiplexed:
+            user_connections[user_id]['video'] = sid
+            user_connections[user_id]['screen'] = sid
+        # 记录采集格式，混音器会把不同格式的流重采样到会议格式
+        audio_format = data.get('audio_format')
+        if audio_format:
+            user_audio_formats[user_id] = (audio_format['rate'], audio_format['channels'], audio_format['chunk'])
+            rate, chunk = audio_format['rate'], audio_format['chunk']
+        else:
+            user_audio_formats.pop(user_id, None)
+            rate, chunk = RATE, CHUNK
+        # 协商音频编解码器（上行按采集格式、下行按会议格式都必须可用），旧客户端不声明codecs时使用原始PCM
+        offered = [codec_id for codec_id in data.get('codecs', []) if codec_id in available_codecs()]
+        user_codecs[user_id] = negotiate_codec(offered, rate, chunk)
+        await sio.emit('connection_registered', {
+            'audio_codec': user_codecs[user_id],
+            'stream_id': assign_stream_id(user_id)
+        }, to=sid)
         print(f"Registered main connection for user {user_id}: {sid}")
 
 @video_sio.on('register_connection')
@@ -79,6 +606,10 @@ async def register_video_connection(sid, data):
             user_connections[user_id] = {}
         user_connections[user_id]['video'] = sid
         print(f"Registered video connection for user {user_id}: {sid}")
+        # 视频连接晚于join_conference登记时补加入房间
+        conf_id = user_conferences.get(user_id)
+        if conf_id in conferences:
+            await video_sio.enter_room(sid, conf_id)
 
 @screen_sio.on('register_connection')
 async def register_screen_connection(sid, data):
@@ -88,6 +619,9 @@ async def register_screen_connection(sid, data):
             user_connections[user_id] = {}
         user_connections[user_id]['screen'] = sid
         print(f"Registered screen connection for user {user_id}: {sid}")
+        conf_id = user_conferences.get(user_id)
+        if conf_id in conferences:
+            await screen_sio.enter_room(sid, conf_id)
 
 # 会议管理
 @sio.on('create_conference')
@@ -101,13 +635,16 @@ async def on_create_conference(sid, data):
         id=str(uuid.uuid4()),
         name=data['name'],
         creator_id=user_id,
-        participants={user_id: data['username']}
+        participants={user_id: data['username']},
+        stream_ids={user_id: assign_stream_id(user_id)}
     )
     conferences[new_conf.id] = new_conf
-    await sio.enter_room(sid, new_conf.id)
+    user_conferences[user_id] = new_conf.id
+    await join_media_rooms(user_id, new_conf.id)
     
     # 创建后直接发送加入成功事件
     await sio.emit('conference_joined', new_conf.to_dict(), room=sid)
+    await start_media_session(sid, user_id)
     # 向其他客户端广播新会议创建事件
     await sio.emit('conference_created', new_conf.to_dict(), skip_sid=sid)
 
@@ -125,23 +662,18 @@ async def on_join_conference(sid, data):
     if conf and len(conf.participants) < conf.max_participants:
         # 使用user_id而不是sid
         conf.participants[user_id] = username
+        conf.stream_ids[user_id] = assign_stream_id(user_id)
+        user_conferences[user_id] = conf_id
         # 仍然使用sid加入房间，因为这是Socket.IO的要求
-        await sio.enter_room(sid, conf_id)
-        video_sid = user_connections.get(user_id, {}).get('video')
-        if video_sid:
-            await video_sio.enter_room(video_sid, conf_id)
-            print(f"Video socket {video_sid} joined room {conf_id}")
-        # 屏幕共享socket加入房间    
-        screen_sid = user_connections.get(user_id, {}).get('screen')
-        if screen_sid:
-            await screen_sio.enter_room(screen_sid, conf_id)
-            print(f"Screen socket {screen_sid} joined room {conf_id}")
+        await join_media_rooms(user_id, conf_id)
         await sio.emit('conference_joined', conf.to_dict(), room=sid)
+        await start_media_session(sid, user_id)
         # 广播时使用user_id
         await sio.emit('participant_joined', {
             'conference_id': conf_id,
             'user_id': user_id,
-            'client_name': username
+            'client_name': username,
+            'stream_id': conf.stream_ids[user_id]
         }, room=conf_id, skip_sid=sid)
     else:
         await sio.emit('join_conference_failed', room=sid)
@@ -162,7 +694,11 @@ async def on_leave_conference(sid, data):
     if conf and user_id in conf.participants:
         client_name = conf.participants[user_id]
         del conf.participants[user_id]
-        await sio.leave_room(sid, conf_id)
+        conf.stream_ids.pop(user_id, None)
+        user_conferences.pop(user_id, None)
+        end_media_session(user_id)
+        close_egress(user_id)
+        await leave_media_rooms(user_id, conf_id)
         
         # 广播时使用user_id
         await sio.emit('participant_left', {
@@ -173,6 +709,7 @@ async def on_leave_conference(sid, data):
 
         # 如果房间为空，立即删除会议
         if not conf.participants:
+            stop_audio_mixing(conf_id)
             if conf_id in conferences:
                 del conferences[conf_id]
             await sio.emit('conference_closed', {'conference_id': conf_id})
@@ -196,13 +733,13 @@ async def on_close_conference(sid, data):
         
         # 清理会议资源
         if conf_id in conferences:
-            if conf_id in audio_mixers:
-                del audio_mixers[conf_id]
+            stop_audio_mixing(conf_id)
             # 让所有参与者离开会议房间
             for participant_user_id in conf.participants:
-                participant_sid = user_connections.get(participant_user_id, {}).get('main')
-                if participant_sid:
-                    await sio.leave_room(participant_sid, conf_id)
+                user_conferences.pop(participant_user_id, None)
+                end_media_session(participant_user_id)
+                close_egress(participant_user_id)
+                await leave_media_rooms(participant_user_id, conf_id)
             del conferences[conf_id]
 
 @sio.on('get_conferences')
@@ -232,81 +769,174 @@ async def on_send_message(sid, data):
         }, room=conf_id)
 
 # 媒体流处理
-# 修改视频处理部分
-@video_sio.on('video')
-async def handle_video(sid, data):
+# 视频和屏幕共享帧只解析头部，原样转发，不重新序列化
+def forward_media(kind, frame, relayed=False):
+    """把视频/屏幕共享帧转发给会议中的其他人
+
+    UDP用户收到分片后的数据报，其余用户的帧放入各自的发送调度器，排在音频和控制消息之后。
+    relayed表示帧来自UDP，分片已经在收到时转发给了UDP用户。
+    """
+    sender = media_sender(frame)
+    if not sender:
+        return
+    header, sender_id, conf_id = sender
+    video_publishers[sender_id] = time.monotonic()
+    layer = header.extra if kind == KIND_VIDEO else 0
+    if kind == KIND_VIDEO:
+        record_layer(sender_id, layer, len(frame))
+    # 联播时每个订阅者只接收为它选择的一层
+    participants = conferences[conf_id].participants
+    others = [user_id for user_id in participants
+              if user_id != sender_id and wants_layer(user_id, sender_id, kind, layer)]
+    deliver_media(kind, frame, sender_id, others, layer, relayed)
+
+    if transcoder and kind == KIND_VIDEO:
+        targets = {}  # {width: [user_id, ...]}
+        for user_id in participants:
+            width = subscriber_transcodes.get(user_id, {}).get(sender_id)
+            # 没有声明过订阅的旧客户端接收所有发布者（按默认窗口大小）
+            subscriptions = video_subscriptions.get(user_id)
+            if width is not None and (subscriptions is None or sender_id in subscriptions):
+                targets.setdefault(width, []).append(user_id)
+        if targets:
+            asyncio.ensure_future(send_transcoded(frame, sender_id, targets))
+
+def deliver_media(kind, frame, sender_id, user_ids, layer=0, relayed=False):
+    """把一帧发给指定的用户：UDP用户收到分片后的数据报，其余用户的帧放入各自的发送调度器"""
+    event, connection, priority = MEDIA_CHANNELS[kind]
+    udp_users = [user_id for user_id in user_ids if user_id in udp_addrs]
+    if udp_users and not relayed:
+        send_udp(udp_users, server_packetizer.packetize(kind, frame, layer))
+    for user_id in user_ids:
+        if user_id not in udp_addrs:
+            egress(user_id).put(priority, event, frame, connection, source=sender_id)
+
+async def send_transcoded(frame, sender_id, targets):
+    """转码后发给需要较小尺寸的订阅者，同一档位的订阅者共用一份数据"""
     try:
-        user_id = data.get('user_id')
-        conf_id = data['conference_id']
-        if not user_id or conf_id not in conferences:
-            print("No user_id or conf_id provided in send_message")
+        variants = await transcoder.variants(sender_id, frame, list(targets))
+        if variants is None:
             return
-            
-        # 获取用户的video socket id
-        video_sid = user_connections.get(user_id, {}).get('video')
-        if video_sid:
-            print(f"Broadcasting video from user {user_id}")
-            await video_sio.emit('video', {
-                'conference_id': conf_id,
-                'data': data['data'],
-                'user_id': user_id
-            }, room=conf_id, skip_sid=video_sid)
+        for width, user_ids in targets.items():
+            # 转码期间可能已经离开会议；原图不比该档位宽时发送原图
+            user_ids = [user_id for user_id in user_ids if user_id in user_conferences]
+            deliver_media(KIND_VIDEO, variants.get(width, frame), sender_id, user_ids)
+    except Exception as e:
+        print(f"Error sending transcoded video: {e}")
+
+@sio.on('video')
+@video_sio.on('video')
+async def handle_video(sid, frame):
+    try:
+        forward_media(KIND_VIDEO, frame)
     except Exception as e:
         print(f"Error broadcasting video: {e}")
 
-# 修改屏幕共享处理部分
+@sio.on('screen_share')
 @screen_sio.on('screen_share')
-async def handle_screen_share(sid, data):
+async def handle_screen_share(sid, frame):
     try:
-        user_id = data.get('user_id')
-        conf_id = data['conference_id']
-        if not user_id or conf_id not in conferences:
-            return
-            
-        # 获取用户的screen socket id
-        screen_sid = user_connections.get(user_id, {}).get('screen')
-        if screen_sid:
-            print(f"Broadcasting screen share from user {user_id}")
-            await screen_sio.emit('screen_share', {
-                'conference_id': conf_id,
-                'data': data['data'],
-                'user_id': user_id
-            }, room=conf_id, skip_sid=screen_sid)
+        forward_media(KIND_SCREEN, frame)
     except Exception as e:
         print(f"Error broadcasting screen share: {e}")
 
 
 @sio.on('audio')
-async def handle_audio(sid, data):
-    """处理接收到的音频数据"""
+async def handle_audio(sid, frame):
+    receive_audio(frame)
+
+def receive_audio(frame):
+    """处理接收到的音频帧（Socket.IO或UDP）：只写入抖动缓冲区，由混音循环定时输出"""
     try:
-        conf_id = data['conference_id']
-        user_id = data['user_id']
-        if not user_id or conf_id not in conferences:
+        sender = media_sender(frame)
+        if not sender:
             return
-            
-        audio_sid = user_connections.get(user_id, {}).get('main')
-        # 确保会议存在音频混音器
+        header, user_id, conf_id = sender
+
+        # 确保会议存在音频混音器，并且混音循环正在运行
         if conf_id not in audio_mixers:
-            audio_mixers[conf_id] = AudioMixer()
-            
-        # 添加音频流到混音器
-        audio_mixers[conf_id].add_audio_stream(user_id, data['data'])
-        
-        # 混合音频
-        mixed_audio = audio_mixers[conf_id].mix_audio()
-        print(f"Mixed audio of {len(mixed_audio)} bytes")
-        # 广播混合后的音频给所有参与者
-        await sio.emit('audio', {
-            'conference_id': conf_id,
-            'data': mixed_audio,
-            'user_id': user_id,
-            'mixed': True  # 标记这是混合后的音频
-        }, room=conf_id, skip_sid=audio_sid)
+            audio_mixers[conf_id] = AudioMixer(capacity=conferences[conf_id].max_participants)
+        global audio_mix_task
+        if audio_mix_task is None:
+            audio_mix_task = asyncio.create_task(audio_mix_loop())
+
+        if header.flags & FLAG_DTX:
+            # 客户端静音保活标记：之后缺失的帧按静音处理
+            audio_mixers[conf_id].mark_silent(user_id)
+            return
+
+        # 解码后添加音频帧到混音器（负载为零拷贝视图）
+        audio_mixers[conf_id].add_audio_stream(user_id, media_payload(frame), header.seq, header.extra,
+                                               user_audio_formats.get(user_id))
     except Exception as e:
         print(f"Error handling audio: {e}")
 
+async def audio_mix_loop():
+    """按照CHUNK/RATE的固定周期，在一次批量运算中为所有会议混音"""
+    global audio_mix_task
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    try:
+        while audio_mixers:
+            # 会议可能在发送期间被关闭，只处理仍然存在的会议
+            active_mixers = {conf_id: mixer for conf_id, mixer in audio_mixers.items() if conf_id in conferences}
+            results = mix_scheduler.mix_all(active_mixers, next_tick)
+            for conf_id, (mixed_audio, personal_mixes) in results.items():
+                if mixed_audio:
+                    await send_mixed_audio(conf_id, active_mixers[conf_id], mixed_audio, personal_mixes)
+            for conf_id, mixer in active_mixers.items():
+                speakers = mixer.speakers.pop_change()
+                if speakers is not None:
+                    # 活跃发言者变化时通知会议中的所有人，经各自的发送队列排在音频之后
+                    data = {'conference_id': conf_id, 'speakers': speakers}
+                    for user_id in conferences[conf_id].participants:
+                        egress(user_id).put(CONTROL, 'active_speakers', data)
+
+            if not results and all(mixer.is_idle() for mixer in active_mixers.values()):
+                # 没有人在说话，结束循环，收到新音频时再启动
+                break
+
+            next_tick += FRAME_DURATION
+            delay = next_tick - loop.time()
+            if delay < -FRAME_DURATION:
+                # 落后超过一个周期时重新对齐，避免追赶时连续突发输出
+                next_tick = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print(f"Error in audio mix loop: {e}")
+    finally:
+        if audio_mix_task is asyncio.current_task():
+            audio_mix_task = None
+
+async def send_mixed_audio(conf_id, mixer, mixed_audio, personal_mixes):
+    """编码并发送一个周期的混音结果
+
+    mix-minus模式下每个发言者收到不含自己声音的个人混音，其余听众收到完整混音；
+    只有一个人发言或不使用mix-minus时，发言者本人不会收到任何音频。
+    """
+    conf = conferences.get(conf_id)
+    if not conf:
+        return
+    recipients = {user_id: user_codecs.get(user_id, PCM16) for user_id in conf.participants}
+    encoded = mixer.encode_tick(mixed_audio, personal_mixes, recipients)
+    for user_id, (codec_id, payload) in encoded.items():
+        # 标记这是混合后的音频，高4位为编解码器ID
+        frame = pack_media_frame(KIND_AUDIO, SERVER_STREAM_ID, mixer.tick_seq, payload,
+                                 flags=FLAG_MIXED, extra=codec_id)
+        if user_id in udp_addrs:
+            send_udp([user_id], server_packetizer.packetize(KIND_AUDIO, frame))
+        else:
+            egress(user_id).put(AUDIO, 'audio', frame)
+
+def stop_audio_mixing(conf_id):
+    """释放会议的混音器，混音循环在没有会议时自动结束"""
+    audio_mixers.pop(conf_id, None)
+
 # 添加视频关闭事件处理
+@sio.on('video_stopped')
 @video_sio.on('video_stopped')
 async def handle_video_stopped(sid, data):
     try:
@@ -316,14 +946,18 @@ async def handle_video_stopped(sid, data):
             return
             
         print(f"Broadcasting video stop from user {user_id}")
-        await video_sio.emit('video_stopped', {
+        if transcoder:
+            transcoder.forget(user_id)
+        send_channel_event(KIND_VIDEO, 'video_stopped', {
             'conference_id': conf_id,
-            'user_id': user_id
-        }, room=conf_id, skip_sid=sid)
+            'user_id': user_id,
+            'seq': data.get('seq')
+        }, conf_id, user_id)
     except Exception as e:
         print(f"Error broadcasting video stop: {e}")
 
 # 添加屏幕共享关闭事件处理
+@sio.on('screen_share_stopped')
 @screen_sio.on('screen_share_stopped')
 async def handle_screen_share_stopped(sid, data):
     try:
@@ -333,10 +967,10 @@ async def handle_screen_share_stopped(sid, data):
             return
             
         print(f"Broadcasting screen share stop from user {user_id}")
-        await screen_sio.emit('screen_share_stopped', {
+        send_channel_event(KIND_SCREEN, 'screen_share_stopped', {
             'conference_id': conf_id,
             'user_id': user_id
-        }, room=conf_id, skip_sid=sid)
+        }, conf_id, user_id)
     except Exception as e:
         print(f"Error broadcasting screen share stop: {e}")
         
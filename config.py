@@ -6,11 +6,106 @@ HELP = 'Create         : create an conference\n' \
 SERVER_IP = '127.0.0.1'
 MAIN_SERVER_PORT = 8888
 TIMEOUT_SERVER = 5
-# DGRAM_SIZE = 1500  # UDP
+DGRAM_SIZE = 1500  # UDP
 LOG_INTERVAL = 2
 
-CHUNK = 512
+CHUNK = 512  # use 320 (20 ms) to allow the optional Opus codec
 CHANNELS = 1  # Channels for audio capture
 RATE = 16000  # Sampling rate for audio capture
 
+# capture format announced to the server; the server resamples/downmixes every
+# stream to RATE/CHANNELS, so clients can capture at their device's native rate
+CAPTURE_RATE = RATE
+CAPTURE_CHANNELS = CHANNELS
+CAPTURE_CHUNK = CHUNK * CAPTURE_RATE // RATE  # frames per capture chunk, same duration as CHUNK
+AUDIO_CAPTURE_BUFFER_CHUNKS = 16  # client capture ring buffer size, in chunks
+RESAMPLER_TAPS_PER_PHASE = 16  # server polyphase resampler filter length per phase
+
+# client-side playback jitter buffer and packet loss concealment
+PLAYBACK_MIN_FRAMES = 2  # minimum frames buffered before playback starts
+PLAYBACK_MAX_FRAMES = 10  # upper bound for the adaptive playout delay
+PLC_MAX_FRAMES = 3  # consecutive lost frames concealed before falling back to silence
+PLC_FADE = 0.6  # gain applied per concealed frame when repeating the last one
+
+# server-side audio jitter buffer (per user), one frame = CHUNK samples
+JITTER_BUFFER_FRAMES = 8  # max frames kept per user before the oldest is dropped
+JITTER_PREFILL_FRAMES = 2  # frames buffered before a stream starts being mixed
+JITTER_EXPIRY = 0.5  # seconds a frame may wait in the buffer before it is discarded
+AUDIO_MIX_MINUS = True  # send every speaker a personal mix without their own voice (off: speakers get nothing)
+
+# active speaker detection
+ACTIVE_SPEAKER_COUNT = 3  # only the loudest N speakers are mixed
+VAD_THRESHOLD = 300  # RMS level (int16) above which a frame counts as speech
+VAD_HANGOVER_FRAMES = 15  # frames a speaker stays active after falling below the threshold
+
+# client-side voice activity detection / discontinuous transmission
+CLIENT_VAD_THRESHOLD = 300  # minimum RMS level (int16) treated as speech
+CLIENT_VAD_NOISE_RATIO = 2.0  # speech must also be this many times louder than the noise floor
+CLIENT_VAD_HANGOVER_FRAMES = 15  # frames still sent after speech ends
+DTX_KEEPALIVE_FRAMES = 30  # while silent, send one keepalive marker every N frames
+
+# run video and screen share over the main Socket.IO connection instead of two extra ones
+MULTIPLEX_CONNECTION = True
+
+# server egress scheduler, one per user: audio > control > video > screen
+# max queued items per priority, oldest dropped first (0 = unbounded); video and screen keep one frame
+# per publisher, so a shared cap would evict other publishers' only frame
+EGRESS_QUEUE_LIMITS = (10, 0, 0, 0)
+EGRESS_STALE_AGE = 0.5  # seconds a video/screen frame may wait before it is dropped
+EGRESS_MAX_BACKLOG = 4  # unsent packets on a connection above which the bandwidth estimate counts it as congested
+EGRESS_POLL_INTERVAL = 0.005  # seconds between backlog checks while video/screen are held back
+EGRESS_BURST = 0.2  # seconds of budget a receiver may burst above its bandwidth estimate
+
+# server-side downstream bandwidth estimation, one estimator per receiver
+BWE_INTERVAL = 0.5  # seconds between RTT probes / estimate updates
+BWE_INITIAL_BPS = 1_000_000  # starting estimate before any feedback
+BWE_MIN_BPS = 100_000
+BWE_MAX_BPS = 20_000_000
+BWE_DELAY_THRESHOLD = 0.1  # queuing delay (seconds above min RTT) treated as congestion
+BWE_RTT_WINDOW = 20  # probes kept for the baseline (min) RTT
+BWE_DECREASE = 0.85  # multiplicative decrease on congestion, applied to the delivered rate
+BWE_INCREASE = 1.08  # multiplicative increase per interval while the link is clear
+BWE_AUDIO_RESERVE_BPS = 64_000  # budget kept aside for audio before splitting video among publishers
+BITRATE_HINT_CHANGE = 0.1  # relative change before a new bitrate hint is sent to a publisher
+
+# optional UDP media plane; Socket.IO stays the control plane and the fallback
+UDP_MEDIA_ENABLED = False  # send/receive media frames over UDP once a conference is joined
+UDP_MEDIA_PORT = 8889  # server UDP port for media datagrams
+UDP_FEC_GROUP = 4  # one XOR parity packet per N fragments of a frame (0 disables FEC)
+UDP_REASSEMBLY_TIMEOUT = 0.5  # seconds an incomplete frame waits for its missing fragments
+UDP_HELLO_ATTEMPTS = 3  # registration datagrams sent when a media session starts
+UDP_HELLO_TIMEOUT = 1.0  # seconds to wait for the server's acknowledgement before staying on Socket.IO
+
+# client adaptive bitrate: floor/ceiling of JPEG quality, downscale factor and frame rate per source
+VIDEO_ABR_PROFILE = {'min_quality': 30, 'max_quality': 75, 'min_scale': 0.5, 'max_scale': 1.0,
+                     'min_fps': 5, 'max_fps': 20}
+SCREEN_ABR_PROFILE = {'min_quality': 40, 'max_quality': 80, 'min_scale': 0.5, 'max_scale': 1.0,
+                      'min_fps': 1, 'max_fps': 10}
+ABR_DECREASE = 0.85  # multiplicative level decrease on congestion
+ABR_INCREASE_STEP = 0.02  # additive level increase per frame while the link keeps up
+ABR_QUEUE_HIGH = 0.6  # send queue fullness treated as congestion
+ABR_BACKLOG_HIGH = 2  # engineio packets still unwritten when the next frame is sent, above this is congestion
+
+# simulcast: every camera frame is also sent as smaller layers, the server forwards one layer
+# per subscriber; (scale relative to the full frame, JPEG quality offset), layer 0 is full size
+SIMULCAST_ENABLED = True
+SIMULCAST_LAYERS = ((1.0, 0), (0.5, -5), (0.25, -10))
+
+# receivers show (and subscribe to) at most this many camera tiles, active speakers first
+VIDEO_GRID_MAX_TILES = 9
+UI_FRAME_INTERVAL_MS = 16  # the Tk thread applies queued UI updates once per display frame
+VIDEO_DECODE_WORKERS = 2  # client threads decoding incoming video straight to the tile size
+# resampling filter per tile class ('nearest', 'bilinear' or 'lanczos'); the spotlight is the only
+# tile or the current active speaker, small tiles are at most VIDEO_SMALL_TILE_WIDTH pixels wide
+VIDEO_RESAMPLE = {'spotlight': 'lanczos', 'tile': 'bilinear', 'small': 'nearest'}
+VIDEO_SMALL_TILE_WIDTH = 320
+VIDEO_RESIZE_DEBOUNCE_MS = 200  # after the window stops resizing, re-layout and resend subscription sizes
+
+# optional server-side transcoding for publishers that do not send simulcast layers: each frame is
+# decoded once and re-encoded at these widths for subscribers with small tiles or slow links
+TRANSCODE_ENABLED = False
+TRANSCODE_WIDTHS = (240, 120)  # pixels, only widths narrower than the source are produced
+TRANSCODE_QUALITY = 60  # JPEG quality of the transcoded variants
+TRANSCODE_WORKERS = 2  # processes in the transcoding pool
+
 camera_width, camera_height = 480, 480  # resolution for camera capture
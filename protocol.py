@@ -1,17 +1,74 @@
-from dataclasses import dataclass
-from typing import Dict, Any, Optional
-
-@dataclass
-class Conference:
-    id: str
-    name: str    
-    creator_id: str
-    participants: Dict[str, str]  # client_id: client_name
-    max_participants: int = 10
-    
-    def to_dict(self) -> Dict[str, Any]:
-        return self.__dict__
-
-    @classmethod
-    def from_dict(cls, data: Dict[str, Any]) -> 'Conference':
-        return cls(**data)
\ No newline at end of file
+import struct
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Any, NamedTuple, Optional
+
+@dataclass
+class Conference:
+    id: str
+    name: str    
+    creator_id: str
+    participants: Dict[str, str]  # client_id: client_name
+    max_participants: int = 10
+    stream_ids: Dict[str, int] = field(default_factory=dict)  # client_id: media stream id
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return self.__dict__
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Conference':
+        return cls(**data)
+
+
+# 二进制媒体帧：固定12字节头部 + 负载
+# kind(B) flags(B) stream_id(H) seq(I) timestamp(I)，网络字节序
+MEDIA_HEADER = struct.Struct('!BBHII')
+MEDIA_HEADER_SIZE = MEDIA_HEADER.size
+
+KIND_AUDIO = 1
+KIND_VIDEO = 2
+KIND_SCREEN = 3
+
+FLAG_MIXED = 0x01  # 服务器混音后的音频
+FLAG_DTX = 0x02  # 静音保活标记，没有负载
+# 高4位：音频为编解码器ID
+FLAG_EXTRA_SHIFT = 4
+
+SERVER_STREAM_ID = 0  # 服务器生成的媒体（混音）使用的流ID
+
+
+class MediaHeader(NamedTuple):
+    kind: int
+    flags: int
+    stream_id: int
+    seq: int
+    timestamp: int  # 采集时间，毫秒，按2^32回绕
+
+    @property
+    def extra(self) -> int:
+        return self.flags >> FLAG_EXTRA_SHIFT
+
+
+def media_timestamp() -> int:
+    """当前时间的毫秒数（按2^32回绕）"""
+    return int(time.time() * 1000) & 0xFFFFFFFF
+
+
+def pack_media_frame(kind: int, stream_id: int, seq: int, payload: bytes = b'', flags: int = 0,
+                     extra: int = 0, timestamp: Optional[int] = None) -> bytes:
+    """打包一个二进制媒体帧"""
+    if timestamp is None:
+        timestamp = media_timestamp()
+    header = MEDIA_HEADER.pack(kind, flags | (extra << FLAG_EXTRA_SHIFT), stream_id,
+                               seq & 0xFFFFFFFF, timestamp)
+    return header + payload
+
+
+def unpack_media_header(frame) -> MediaHeader:
+    """只解析头部，不复制负载"""
+    return MediaHeader(*MEDIA_HEADER.unpack_from(frame))
+
+
+def media_payload(frame) -> memoryview:
+    """负载部分的零拷贝视图"""
+    return memoryview(frame)[MEDIA_HEADER_SIZE:]
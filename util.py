@@ -3,6 +3,7 @@ Simple util implementation for video conference
 Including data capture, image compression and image overlap
 Note that you can use your own implementation as well :)
 '''
+import time
 from io import BytesIO
 import pyaudio
 import cv2
@@ -15,9 +16,88 @@ from config import *
 # audio setting
 FORMAT = pyaudio.paInt16
 audio = pyaudio.PyAudio()
-streamin = audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
 streamout = audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, output=True, frames_per_buffer=CHUNK)
 
+
+class AudioCaptureBuffer:
+    """
+    Single-producer/single-consumer ring buffer for captured audio.
+    The PyAudio callback thread only advances write_index and the asyncio sender
+    only advances read_index, so no lock is needed. When the consumer falls behind,
+    new chunks are dropped (and counted) instead of overwriting unread audio.
+    """
+
+    def __init__(self, capacity_chunks=AUDIO_CAPTURE_BUFFER_CHUNKS, chunk=CAPTURE_CHUNK * CAPTURE_CHANNELS,
+                 chunk_duration=CAPTURE_CHUNK / CAPTURE_RATE):
+        self.chunk = chunk
+        self.chunk_duration = chunk_duration
+        self.capacity = capacity_chunks
+        self.buffer = np.zeros((capacity_chunks, chunk), dtype=np.int16)
+        self.write_index = 0  # total chunks written, owned by the producer
+        self.read_index = 0  # total chunks read, owned by the consumer
+        self.next_due = None  # time by which the next chunk should have been captured, owned by the consumer
+        # statistics
+        self.overflows = 0  # chunks dropped because the buffer was full
+        self.device_overflows = 0  # input overflows reported by PortAudio
+        self.underruns = 0  # chunks that were due (a chunk period after the last one) but not captured
+
+    def write(self, data, status=0):
+        """called from the PyAudio callback thread"""
+        if status & pyaudio.paInputOverflow:
+            self.device_overflows += 1
+        if self.write_index - self.read_index >= self.capacity:
+            self.overflows += 1
+            return
+        samples = np.frombuffer(data, dtype=np.int16, count=min(len(data) // 2, self.chunk))
+        row = self.buffer[self.write_index % self.capacity]
+        row[:len(samples)] = samples
+        row[len(samples):] = 0
+        self.write_index += 1
+
+    def read(self):
+        """non-blocking read of one chunk, returns bytes or None when nothing is available"""
+        now = time.monotonic()
+        if self.write_index == self.read_index:
+            # polling faster than the capture rate is expected, only a missed chunk counts
+            if self.next_due is not None and now > self.next_due:
+                self.underruns += 1
+                self.next_due += self.chunk_duration
+            return None
+        data = self.buffer[self.read_index % self.capacity].tobytes()
+        self.read_index += 1
+        self.next_due = now + self.chunk_duration
+        return data
+
+    def available(self):
+        return self.write_index - self.read_index
+
+    def clear(self):
+        """drop everything not read yet (consumer side)"""
+        self.read_index = self.write_index
+        self.next_due = None
+
+    def stats(self):
+        return {
+            'buffered': self.available(),
+            'overflows': self.overflows,
+            'device_overflows': self.device_overflows,
+            'underruns': self.underruns,
+        }
+
+
+capture_buffer = AudioCaptureBuffer()
+
+
+def _capture_callback(in_data, frame_count, time_info, status):
+    capture_buffer.write(in_data, status)
+    return None, pyaudio.paContinue
+
+
+# capture runs in PortAudio's callback thread and never blocks the event loop
+# the capture format may differ from RATE/CHANNELS, the server converts it
+streamin = audio.open(format=FORMAT, channels=CAPTURE_CHANNELS, rate=CAPTURE_RATE, input=True,
+                      frames_per_buffer=CAPTURE_CHUNK, stream_callback=_capture_callback, start=False)
+
 # print warning if no available camera
 cap = cv2.VideoCapture(0)
 if cap.isOpened():
@@ -118,8 +198,74 @@ def capture_camera():
     return Image.fromarray(frame)
 
 
+def start_voice_capture():
+    capture_buffer.clear()
+    if not streamin.is_active():
+        streamin.start_stream()
+
+
+def stop_voice_capture():
+    if streamin.is_active():
+        streamin.stop_stream()
+    capture_buffer.clear()
+
+
 def capture_voice():
-    return streamin.read(CHUNK)
+    """non-blocking: return one captured chunk, or None if no complete chunk is buffered yet"""
+    return capture_buffer.read()
+
+
+class VoiceActivityDetector:
+    """
+    Client-side voice activity detection for discontinuous transmission (DTX).
+    Silent frames are suppressed; while silent, a keepalive marker is sent every
+    DTX_KEEPALIVE_FRAMES frames so the server knows the microphone is still on.
+    """
+    SPEECH = 'speech'
+    KEEPALIVE = 'keepalive'
+    SILENCE = 'silence'
+
+    def __init__(self, threshold=CLIENT_VAD_THRESHOLD, noise_ratio=CLIENT_VAD_NOISE_RATIO,
+                 hangover=CLIENT_VAD_HANGOVER_FRAMES, keepalive_interval=DTX_KEEPALIVE_FRAMES):
+        self.threshold = threshold
+        self.noise_ratio = noise_ratio
+        self.hangover = hangover
+        self.keepalive_interval = keepalive_interval
+        self.noise_floor = threshold / noise_ratio
+        self._hold = 0
+        self._silent_frames = 0
+        # statistics
+        self.sent_frames = 0
+        self.suppressed_frames = 0
+
+    def process(self, audio_data):
+        """
+        classify one captured chunk
+        :param audio_data: bytes, 16-bit PCM
+        :return: str, SPEECH (send the frame), KEEPALIVE (send a marker) or SILENCE (send nothing)
+        """
+        samples = np.frombuffer(audio_data, dtype=np.int16)
+        rms = float(np.sqrt(np.mean(np.square(samples, dtype=np.float32)))) if len(samples) else 0.0
+
+        if rms >= max(self.threshold, self.noise_floor * self.noise_ratio):
+            self._hold = self.hangover
+        else:
+            # track the background level only while nobody is talking
+            rate = 0.05 if rms > self.noise_floor else 0.5
+            self.noise_floor += rate * (rms - self.noise_floor)
+            if self._hold > 0:
+                self._hold -= 1
+
+        if self._hold > 0:
+            self._silent_frames = 0
+            self.sent_frames += 1
+            return self.SPEECH
+
+        self.suppressed_frames += 1
+        self._silent_frames += 1
+        if (self._silent_frames - 1) % self.keepalive_interval == 0:
+            return self.KEEPALIVE
+        return self.SILENCE
 
 
 def compress_image(image, format='JPEG', quality=85):
@@ -138,6 +284,25 @@ def compress_image(image, format='JPEG', quality=85):
     return img_byte_arr
 
 
+def compress_simulcast(image, quality=85, layers=SIMULCAST_LAYERS):
+    """
+    encode one captured frame as simulcast layers, largest first
+
+    :param image: PIL.Image, input image
+    :param quality: int, JPEG quality of the full-size layer
+    :param layers: sequence of (scale, quality offset), layer 0 should be (1.0, 0)
+    :return: list of bytes, one compressed image per layer
+    """
+    encoded = []
+    for scale, quality_offset in layers:
+        layer = image
+        if scale < 1.0:
+            size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+            layer = image.resize(size, Image.BILINEAR)
+        encoded.append(compress_image(layer, quality=max(10, quality + quality_offset)))
+    return encoded
+
+
 def decompress_image(image_bytes):
     """
     decompress bytes to PIL.Image